@@ -1,33 +1,34 @@
+import time
+SCRIPT_START_TIME = time.perf_counter() # For the startup budget check at the end of the script
+
 import streamlit as st
 import os
 import io
 import json
 import re
 import bcrypt
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
 from datetime import datetime
-import time
 import base64 # Import base64 for image encoding
-
-# --- Firebase Imports ---
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from firebase_admin import exceptions # Import exceptions module for FirebaseError
-
-# --- Google Drive Imports ---
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-
-# --- AI & Document Processing Imports ---
-from openai import OpenAI
-import pandas as pd
-from PyPDF2 import PdfReader
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.section import WD_SECTION_START
-from docx.enum.table import WD_ALIGN_VERTICAL
-from docx.oxml.ns import qn # For font color
+import copy
+import shutil
+import uuid
+import random
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import itertools
+
+# Heavy third-party modules (firebase_admin, googleapiclient, openai, numpy, python-docx, PyPDF2)
+# are imported inside the functions that use them, so the login pages render without loading them.
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from document_extraction import extract_texts_in_pool, ExtractionWorkerStalled, iter_zip_documents, EXTRACTION_LIMITS_TAG
+from docx_report import create_comparative_docx_report
 
 
 # --- Streamlit Page Configuration (MUST BE THE FIRST ST COMMAND) ---
@@ -38,8 +39,7 @@ st.set_page_config(
 )
 
 # --- Custom CSS for Styling ---
-st.markdown(
-    """
+CUSTOM_CSS = """
     <style>
     /* Global base styling - pure white background, pure black text by default */
     body {
@@ -264,9 +264,19 @@ st.markdown(
     /* END OF NEW CODE TO FIX SELECTBOX WIDTH */
 
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+@st.cache_resource
+def load_static_assets():
+    # Prepared once per server process instead of on every rerun: the CSS is minified
+    # (comments and whitespace stripped) and the logo is read and base64-encoded.
+    css_html = re.sub(r"\s+", " ", re.sub(r"/\*.*?\*/", "", CUSTOM_CSS, flags=re.S)).strip()
+    with open("logo.png", "rb") as logo_file:
+        logo_base64 = base64.b64encode(logo_file.read()).decode()
+    logo_html = f'<img src="data:image/png;base64,{logo_base64}" class="fixed-top-left-logo">'
+    return {"css_html": css_html, "logo_html": logo_html}
+
+st.markdown(load_static_assets()["css_html"], unsafe_allow_html=True)
 
 # --- Session State Initialization ---
 if 'logged_in' not in st.session_state:
@@ -293,27 +303,78 @@ if 'current_admin_page' not in st.session_state:
     st.session_state['current_admin_page'] = 'reports'
 
 
-# --- Firebase Initialization ---
-# Ensure only one app instance is initialized
-if not firebase_admin._apps:
-    try:
-        # Load the Firebase service account JSON string from Streamlit secrets
-        # The key name is "FIREBASE_SERVICE_ACCOUNT_KEY" as per your secrets.toml
-        firebase_service_account_json_str = st.secrets["FIREBASE_SERVICE_ACCOUNT_KEY"]
-        # Parse the JSON string into a Python dictionary
-        firebase_service_account_info = json.loads(firebase_service_account_json_str)
-
-        # Explicitly replace '\n' with actual newline characters in the private_key
-        # This is crucial because Streamlit's TOML parser might preserve '\\n' as literal escapes
-        # if the original JSON file had them, and firebase_admin expects actual newlines.
-        if "private_key" in firebase_service_account_info:
-            firebase_service_account_info["private_key"] = firebase_service_account_info["private_key"].replace('\\n', '\n')
-
-        cred = credentials.Certificate(firebase_service_account_info)
+# --- Shared API Clients ---
+# Built once per server process with st.cache_resource and shared by every session, instead of
+# re-parsing the service-account JSON and rebuilding the clients on every Streamlit rerun.
+# (Failures are not cached, so a fixed secret is picked up on the next rerun.)
+OPENAI_MAX_CONNECTIONS = 64 # Shared keep-alive pool for all concurrent OpenAI requests
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 32
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = 120
+
+def load_service_account_info(secret_name):
+    # Parse the service account JSON string stored in Streamlit secrets
+    service_account_info = json.loads(st.secrets[secret_name])
+    # Explicitly replace '\n' with actual newline characters in the private_key
+    # This is crucial because Streamlit's TOML parser might preserve '\\n' as literal escapes
+    # if the original JSON file had them, and the Google libraries expect actual newlines.
+    if "private_key" in service_account_info:
+        service_account_info["private_key"] = service_account_info["private_key"].replace('\\n', '\n')
+    return service_account_info
+
+@st.cache_resource
+def load_firestore_client():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    # Ensure only one app instance is initialized
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(load_service_account_info("FIREBASE_SERVICE_ACCOUNT_KEY"))
         firebase_admin.initialize_app(cred) # Use firebase_admin.initialize_app
-        db = firestore.client()
-        st.success("Firebase initialized successfully.")
+        print("DEBUG: Firebase initialized successfully.")
+    return firestore.client()
+
+@st.cache_resource
+def load_drive_service():
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from googleapiclient.http import HttpRequest
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+
+    # Define the necessary scopes for Google Drive access
+    SCOPES = ['https://www.googleapis.com/auth/drive'] # Scope for full Drive access
+    drive_credentials = service_account.Credentials.from_service_account_info(load_service_account_info("GOOGLE_DRIVE_KEY"), scopes=SCOPES)
 
+    # httplib2 connections aren't thread-safe, so each request gets its own authorized transport;
+    # the parsed discovery document and the service object itself are shared.
+    def build_request(http, *args, **kwargs):
+        return HttpRequest(AuthorizedHttp(drive_credentials, http=httplib2.Http()), *args, **kwargs)
+
+    # Build the Google Drive API service client
+    return build('drive', 'v3', credentials=drive_credentials, requestBuilder=build_request, cache_discovery=False)
+
+@st.cache_resource
+def load_openai_client():
+    from openai import OpenAI, DefaultHttpxClient
+    import httpx
+    # One client (and so one keep-alive HTTP connection pool) for every request in the process
+    return OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        max_retries=0, # Retries go through the rate-limit scheduler (get_openai_scheduler) instead
+        http_client=DefaultHttpxClient(limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS
+        ))
+    )
+
+# The get_* accessors below are used from page code: they create the client on first use and,
+# if the secrets are missing or invalid, explain the problem on the page and stop the run.
+# Background threads call the load_* functions directly and handle the exception themselves.
+
+# --- Firebase Initialization ---
+def get_db():
+    try:
+        return load_firestore_client()
     except KeyError:
         st.error("Firebase 'FIREBASE_SERVICE_ACCOUNT_KEY' not found in Streamlit secrets! "
                  "Please add your Firebase service account JSON content as a multi-line string "
@@ -327,63 +388,24 @@ if not firebase_admin._apps:
         st.error(f"An unexpected error occurred during Firebase initialization: {e}")
         st.info("Please ensure your 'FIREBASE_SERVICE_ACCOUNT_KEY' is valid and correctly formatted in secrets.toml.")
         st.stop()
-else:
-    db = firestore.client()
 
 # --- Google Drive Configuration ---
-drive_service = None
-try:
-    # Load the Google Drive key JSON string from Streamlit secrets
-    # The key name is "GOOGLE_DRIVE_KEY" as per your secrets.toml
-    google_drive_key_json_str = st.secrets["GOOGLE_DRIVE_KEY"]
-    # Parse the JSON string into a Python dictionary
-    google_drive_key_info = json.loads(google_drive_key_json_str)
-
-    # Explicitly replace '\n' with actual newline characters in the private_key
-    if "private_key" in google_drive_key_info:
-        google_drive_key_info["private_key"] = google_drive_key_info["private_key"].replace('\\n', '\n')
-
-    # Define the necessary scopes for Google Drive access
-    SCOPES = ['https://www.googleapis.com/auth/drive'] # Scope for full Drive access
-
-    # Create credentials from the service account info
-    drive_credentials = service_account.Credentials.from_service_account_info(google_drive_key_info, scopes=SCOPES)
-
-    # Build the Google Drive API service client
-    drive_service = build('drive', 'v3', credentials=drive_credentials)
-    
-
-except KeyError:
-    st.error("Google Drive 'GOOGLE_DRIVE_KEY' not found in Streamlit secrets! "
-             "Please add your Google Drive service account JSON content as a multi-line string "
-             "to your app's secrets.toml under the key 'GOOGLE_DRIVE_KEY'.")
-    st.stop()
-except json.JSONDecodeError as e:
-    st.error(f"Error decoding Google Drive key JSON: {e}. "
-             "Please ensure 'GOOGLE_DRIVE_KEY' in secrets.toml is valid JSON.")
-    st.stop()
-except Exception as e:
-    st.error(f"An unexpected error occurred during Google Drive initialization: {e}")
-    st.info("Please ensure your 'GOOGLE_DRIVE_KEY' is valid and Google Drive API is enabled in secrets.toml.")
-    st.stop()
-
-# --- OpenAI API Key Setup ---
-openai_client = None
-try:
-    # Load the OpenAI API key from Streamlit secrets
-    openai_api_key = st.secrets["OPENAI_API_KEY"]
-    # Initialize the OpenAI client with the loaded API key
-    openai_client = OpenAI(api_key=openai_api_key)
-    
-
-except KeyError:
-    st.error("OPENAI_API_KEY not found in Streamlit secrets! "
-             "Please add your OpenAI API key to your app's secrets "
-             "on Streamlit Community Cloud under the key 'OPENAI_API_KEY'.")
-    st.stop()
-except Exception as e:
-    st.error(f"An unexpected error occurred during OpenAI API key setup: {e}")
-    st.stop()
+def get_drive_service():
+    try:
+        return load_drive_service()
+    except KeyError:
+        st.error("Google Drive 'GOOGLE_DRIVE_KEY' not found in Streamlit secrets! "
+                 "Please add your Google Drive service account JSON content as a multi-line string "
+                 "to your app's secrets.toml under the key 'GOOGLE_DRIVE_KEY'.")
+        st.stop()
+    except json.JSONDecodeError as e:
+        st.error(f"Error decoding Google Drive key JSON: {e}. "
+                 "Please ensure 'GOOGLE_DRIVE_KEY' in secrets.toml is valid JSON.")
+        st.stop()
+    except Exception as e:
+        st.error(f"An unexpected error occurred during Google Drive initialization: {e}")
+        st.info("Please ensure your 'GOOGLE_DRIVE_KEY' is valid and Google Drive API is enabled in secrets.toml.")
+        st.stop()
 
 # --- Google Drive Reports Folder ID (from secrets) ---
 GOOGLE_DRIVE_REPORTS_FOLDER_ID = None
@@ -396,6 +418,50 @@ except KeyError:
     st.stop()
 
 
+# --- Local Cache Settings ---
+# All on-disk caches live under this directory (one sub-directory per cache).
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+TEXT_CACHE_MEMORY_ENTRIES = 256 # Extracted documents kept in-process
+TEXT_CACHE_DISK_BYTES = 200 * 1024 * 1024 # Size cap for extracted text on disk
+LLM_CACHE_DISK_BYTES = 500 * 1024 * 1024 # Size cap for cached OpenAI responses
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60 # Cached OpenAI responses expire after a week
+REPORT_DOCX_CACHE_DISK_BYTES = 300 * 1024 * 1024 # Size cap for rendered report documents
+JD_PROFILE_CACHE_DISK_BYTES = 20 * 1024 * 1024 # Size cap for compiled JD requirement profiles
+
+# --- Concurrency Settings ---
+# Upper bound on simultaneous OpenAI requests made while generating a single report.
+MAX_CONCURRENT_AI_REQUESTS = int(st.secrets.get("MAX_CONCURRENT_AI_REQUESTS", 8))
+# Models: OPENAI_MODEL for all analysis, and the smaller OPENAI_SCREENING_MODEL for the first pass of
+# tiered candidate evaluation (see get_tiered_candidate_evaluation_data).
+OPENAI_MODEL = st.secrets.get("OPENAI_MODEL", "gpt-4o")
+OPENAI_SCREENING_MODEL = st.secrets.get("OPENAI_SCREENING_MODEL", "gpt-4o-mini")
+# Default MatchPercent band (inclusive) of screened candidates that are re-evaluated with OPENAI_MODEL
+ESCALATION_MATCH_BAND = (50, 100)
+# The OpenAI account's rate limits, which OpenAI applies per model; each model's limits are shared by
+# every report being generated in the process. OPENAI_RATE_LIMITS maps a model name to
+# {requests_per_minute = ..., tokens_per_minute = ...}; models not listed there use the defaults below.
+OPENAI_REQUESTS_PER_MINUTE = int(st.secrets.get("OPENAI_REQUESTS_PER_MINUTE", 500))
+OPENAI_TOKENS_PER_MINUTE = int(st.secrets.get("OPENAI_TOKENS_PER_MINUTE", 30000))
+OPENAI_RATE_LIMITS = {model: dict(limits) for model, limits in st.secrets.get("OPENAI_RATE_LIMITS", {}).items()}
+OPENAI_COMPLETION_TOKENS_ESTIMATE = 1000 # Reserved per request for the response, corrected from the reported usage
+OPENAI_MAX_RETRIES = 6
+OPENAI_BACKOFF_BASE_SECONDS = 1
+OPENAI_BACKOFF_MAX_SECONDS = 60
+# Worker processes for PDF/DOCX extraction, and the time limit for parsing a single file.
+EXTRACTION_WORKERS = os.cpu_count() or 1
+EXTRACTION_TIMEOUT_SECONDS = 30
+
+
+# Prompt size (estimated tokens) above which the criteria comparison is split into candidate batches.
+CRITERIA_PROMPT_TOKEN_BUDGET = int(st.secrets.get("CRITERIA_PROMPT_TOKEN_BUDGET", 30000))
+CRITERIA_PROMPT_OVERHEAD_TOKENS = 500 # Instructions and criteria list around the JD/CV texts
+# Candidate evaluations pack several CVs into one request, up to this prompt size and candidate count
+# (EVALUATION_BATCH_MAX_CANDIDATES = 1 evaluates every CV on its own).
+EVALUATION_BATCH_TOKEN_BUDGET = int(st.secrets.get("EVALUATION_BATCH_TOKEN_BUDGET", 12000))
+EVALUATION_BATCH_MAX_CANDIDATES = int(st.secrets.get("EVALUATION_BATCH_MAX_CANDIDATES", 8))
+EVALUATION_PROMPT_OVERHEAD_TOKENS = 400
+
+
 # --- Utility Functions ---
 
 # Function to hash passwords for Firestore storage (for local emulator login)
@@ -407,6 +473,8 @@ def check_password(password, hashed_password):
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def login_user(email, password): # Removed desired_login_type, as is_admin is from DB
+    from firebase_admin import auth
+    db = get_db() # Also initializes Firebase for the Auth calls
     try:
         user = auth.get_user_by_email(email)
         user_doc_ref = db.collection('users').document(user.uid)
@@ -467,6 +535,9 @@ def login_user(email, password): # Removed desired_login_type, as is_admin is fr
         st.error(f"Login error: {e}")
 
 def create_user(email, password, is_admin=False):
+    from firebase_admin import auth, firestore
+    from firebase_admin import exceptions # Import exceptions module for FirebaseError
+    db = get_db() # Also initializes Firebase for the Auth calls
     try:
         user_record = auth.create_user(email=email, password=password)
         user_ref = db.collection('users').document(user_record.uid)
@@ -492,68 +563,761 @@ def create_user(email, password, is_admin=False):
         return None
 
 def logout_user():
-    for key in ['logged_in', 'user_email', 'user_uid', 'is_admin', 'username', 'has_set_username', 'needs_username_setup', 'login_success', 'current_admin_page', 'login_mode', 'is_admin_attempt']:
+    for key in ['logged_in', 'user_email', 'user_uid', 'is_admin', 'username', 'has_set_username', 'needs_username_setup', 'login_success', 'current_admin_page', 'login_mode', 'is_admin_attempt', 'report_job_id', 'report_page_cursors']:
         if key in st.session_state:
             del st.session_state[key]
     st.session_state['login_mode'] = 'choose_role' # Reset to role selection on logout
     st.rerun()
 
-# --- Content Extraction Functions ---
-def get_pdf_text(file):
-    pdf_reader = PdfReader(file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() or ""
-    return text
-
-def get_docx_text(file):
-    document = Document(file)
-    text = ""
-    for paragraph in document.paragraphs:
-        text += paragraph.text + "\n"
-    return text
+# --- Caching ---
+class MemoryLRUCache:
+    # Small thread-safe in-process LRU keyed by string.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskLRUCache:
+    # Bounded on-disk cache storing one file per key. A file's mtime is its write time and its
+    # atime its last use: reads set the atime explicitly, so evicting the oldest atimes first gives
+    # LRU order. Entries written more than ttl_seconds ago (if set) are treated as misses and
+    # removed, however often they have been read since.
+    def __init__(self, directory, max_bytes, ttl_seconds=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                written_at = os.path.getmtime(path)
+                if self.ttl_seconds is not None and time.time() - written_at > self.ttl_seconds:
+                    self._remove(path)
+                    self.misses += 1
+                    return None
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path, (time.time(), written_at)) # Mark as used, keeping the write time for the TTL
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path) # Atomic, so readers never see a half-written entry
+            except OSError as e:
+                print(f"DEBUG: Could not write cache entry {path}: {e}")
+                return
+            self._total_bytes += len(data) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._total_bytes -= size
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its cap
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()), key=lambda e: e.stat().st_atime)
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes * 0.9:
+                break
+            self._remove(entry.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+class TextExtractionCache:
+    # Two-tier cache of extracted document text, keyed by a hash of the file bytes
+    # (content-addressed, so the same CV uploaded under another name still hits).
+    def __init__(self, memory_entries, disk_directory, disk_max_bytes):
+        self.memory = MemoryLRUCache(memory_entries)
+        self.disk = DiskLRUCache(disk_directory, disk_max_bytes)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock() # Guards the counters, which every session updates
+
+    @staticmethod
+    def make_key(file_bytes, file_kind):
+        return f"{file_kind}-{hashlib.sha256(file_bytes).hexdigest()}"
+
+    def get(self, key):
+        text = self.memory.get(key)
+        if text is not None:
+            with self._lock:
+                self.memory_hits += 1
+            return text
+        data = self.disk.get(key)
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+            text = data.decode("utf-8")
+            self.memory.set(key, text)
+            return text
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, text):
+        self.memory.set(key, text)
+        self.disk.set(key, text.encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            memory_hits, disk_hits, misses = self.memory_hits, self.disk_hits, self.misses
+        lookups = memory_hits + disk_hits + misses
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": (memory_hits + disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk.stats()["bytes"]
+        }
+
+@st.cache_resource
+def get_text_extraction_cache():
+    # One cache per server process, shared by every session
+    return TextExtractionCache(TEXT_CACHE_MEMORY_ENTRIES, os.path.join(CACHE_DIR, "extracted_text"), TEXT_CACHE_DISK_BYTES)
+
+@st.cache_resource
+def get_llm_response_cache():
+    return DiskLRUCache(os.path.join(CACHE_DIR, "llm_responses"), LLM_CACHE_DISK_BYTES, ttl_seconds=LLM_CACHE_TTL_SECONDS)
+
+@st.cache_resource
+def get_jd_profile_cache():
+    # Compiled JD requirement profiles, keyed by a hash of the JD text (see compile_jd_profile)
+    return DiskLRUCache(os.path.join(CACHE_DIR, "jd_profiles"), JD_PROFILE_CACHE_DISK_BYTES, ttl_seconds=LLM_CACHE_TTL_SECONDS)
+
+@st.cache_resource
+def get_report_docx_cache():
+    # Rendered report documents, keyed by report_docx_cache_key()
+    return DiskLRUCache(os.path.join(CACHE_DIR, "report_docx"), REPORT_DOCX_CACHE_DISK_BYTES)
+
+PDF_MIME_TYPE = "application/pdf"
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+@st.cache_resource
+def get_extraction_pool():
+    # Spawned (not forked) workers, since the Streamlit server process is multi-threaded
+    return ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def replace_extraction_pool(executor):
+    # Drops the cached pool so the next call builds a new one, and stops the old one's workers.
+    # shutdown() alone would leave a worker stuck inside a file running, so they are terminated.
+    get_extraction_pool.clear()
+    worker_processes = list((executor._processes or {}).values()) # Gone from the executor after shutdown()
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in worker_processes:
+        process.terminate()
+
+def get_file_kind(uploaded_file):
+    if uploaded_file.type == PDF_MIME_TYPE:
+        return "pdf"
+    if uploaded_file.type == DOCX_MIME_TYPE:
+        return "docx"
+    return None
+
+def extract_documents_text(documents):
+    # documents is an iterable of (name, file_kind, file_bytes) - a list of uploads or a generator
+    # streaming ZIP members - and the result is one (name, text, error) tuple per document, in order.
+    # Results are cached by file content so re-runs and re-uploads skip parsing; the remaining files
+    # are parsed in parallel on the extraction process pool, each bounded by EXTRACTION_TIMEOUT_SECONDS.
+    cache = get_text_extraction_cache()
+    results = []
+    misses = [] # (index into results, cache key)
+
+    def cache_misses():
+        for name, file_kind, file_bytes in documents:
+            if file_kind is None:
+                results.append((name, None, "Unsupported file type."))
+                continue
+            cache_key = cache.make_key(file_bytes, f"{file_kind}-{EXTRACTION_LIMITS_TAG}")
+            text = cache.get(cache_key)
+            if text is not None:
+                results.append((name, text, None))
+                continue
+            misses.append((len(results), cache_key))
+            results.append((name, None, None))
+            yield file_kind, file_bytes
+
+    # Every miss goes to the pool, even a single file: only a worker process can interrupt a
+    # pathological file with SIGALRM, which doesn't fire on the script thread.
+    pending_files = cache_misses()
+    extracted = []
+    while True:
+        executor = get_extraction_pool()
+        try:
+            extracted.extend(extract_texts_in_pool(executor, pending_files, EXTRACTION_TIMEOUT_SECONDS, EXTRACTION_WORKERS))
+            break
+        except ExtractionWorkerStalled as e:
+            # A worker is stuck in a file it can't be interrupted in, so the pool is replaced. The
+            # stalled file is marked as timed out and the other files in flight are sent again.
+            replace_extraction_pool(executor)
+            extracted.extend(e.completed_results)
+            pending_files = itertools.chain(e.unfinished_files, pending_files)
+        except BrokenProcessPool as e:
+            # A crashed worker breaks the whole pool, so a new one is built straight away. Files
+            # already parsed keep their text, the ones in flight with the crash are marked failed,
+            # and the rest of the stream continues on the new pool.
+            replace_extraction_pool(executor)
+            extracted.extend(e.completed_results)
+
+    for (i, cache_key), (text, error) in zip(misses, extracted):
+        if text is not None:
+            cache.set(cache_key, text)
+        results[i] = (results[i][0], text, error)
+    return results
+
+# --- OpenAI Rate Limiting ---
+# Every OpenAI request in the process goes through the scheduler for its model. Two token buckets
+# (requests and tokens per minute) hold requests back before they would exceed that model's limits, so
+# concurrent report jobs share the budget instead of tripping 429s. Rate-limit, timeout, connection
+# and server errors are retried with jittered exponential backoff; a Retry-After from OpenAI pauses
+# every request until it has passed.
+class TokenBucket:
+    # Budget of `per_minute` units, refilled continuously. The level may go negative when a
+    # request costs more than was estimated; later requests then wait for it to be paid back.
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.refill_per_second = self.capacity / 60
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def seconds_until_available(self, amount):
+        # Capped at capacity so that a single oversized request can still run once the bucket is full
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.refill_per_second)
+
+
+def parse_retry_after_seconds(headers):
+    # OpenAI sends retry-after-ms and/or retry-after (seconds, or an HTTP date)
+    from email.utils import parsedate_to_datetime
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            retry_at = parsedate_to_datetime(retry_after)
+            return (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAIRequestScheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self, estimated_tokens):
+        # Blocks until both budgets allow the request (and any Retry-After pause is over), then spends them
+        started_at = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                wait_seconds = max(self._paused_until - now,
+                                   self._requests.seconds_until_available(1),
+                                   self._tokens.seconds_until_available(estimated_tokens))
+                if wait_seconds <= 0:
+                    self._requests.level -= 1
+                    self._tokens.level -= estimated_tokens
+                    break
+                self._condition.wait(timeout=wait_seconds)
+            waited_seconds = time.monotonic() - started_at
+            self.requests += 1
+            self.throttled_seconds += waited_seconds
+        return waited_seconds
+
+    def settle(self, estimated_tokens, actual_tokens):
+        # Charges (or refunds) the difference between the estimate and what OpenAI reports
+        with self._condition:
+            self._tokens.level -= actual_tokens - estimated_tokens
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def retry_delay(self, error, attempt):
+        # Seconds to wait before retrying after `error`, or None if retrying won't help
+        import openai
+        if isinstance(error, openai.RateLimitError):
+            if getattr(error, "code", None) == "insufficient_quota":
+                return None # Out of credit, not rate limited
+            retryable = True
+        elif isinstance(error, openai.APIStatusError):
+            retryable = error.status_code in (408, 409) or error.status_code >= 500
+        else:
+            retryable = isinstance(error, openai.APIConnectionError) # Includes timeouts
+        if not retryable:
+            return None
+
+        backoff = min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0) # Jitter
+        response = getattr(error, "response", None)
+        retry_after = parse_retry_after_seconds(response.headers) if response is not None else None
+        delay = max(backoff, retry_after or 0)
+        if isinstance(error, openai.RateLimitError):
+            with self._condition:
+                self.rate_limited += 1
+            self.pause(delay) # The limit is shared by every request for this model, so hold them all back
+        return delay
+
+    def call(self, request_fn, estimated_tokens, call_stats=None):
+        # Runs request_fn() (an OpenAI API call) within the budgets, retrying transient failures.
+        # The last error is raised once retries are exhausted or the error isn't retryable.
+        # call_stats, if given, is filled with this call's retries and time spent waiting for budget.
+        call_stats = call_stats if call_stats is not None else {}
+        call_stats.update(retries=0, throttled_seconds=0.0)
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            call_stats["throttled_seconds"] += self.acquire(estimated_tokens)
+            try:
+                response = request_fn()
+            except Exception as e:
+                # A failed request (a 429 above all) used none of OpenAI's token budget, so the
+                # estimate is refunded rather than throttling later requests for nothing
+                self.settle(estimated_tokens, 0)
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                call_stats["retries"] += 1
+                with self._condition:
+                    self.retries += 1
+                print(f"DEBUG: OpenAI request failed ({type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt + 1} of {OPENAI_MAX_RETRIES})")
+                time.sleep(delay)
+                continue
+            usage = getattr(response, "usage", None)
+            if usage is not None and getattr(usage, "total_tokens", None):
+                self.settle(estimated_tokens, usage.total_tokens)
+            return response
+
+    def stats(self):
+        with self._condition:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "throttled_seconds": self.throttled_seconds
+            }
+
+@st.cache_resource
+def get_openai_scheduler(model):
+    # One scheduler per model and server process: OpenAI applies each model's rate limits across
+    # the whole organization, so every session's requests for the model share its budgets
+    limits = OPENAI_RATE_LIMITS.get(model, {})
+    return OpenAIRequestScheduler(int(limits.get("requests_per_minute", OPENAI_REQUESTS_PER_MINUTE)),
+                                  int(limits.get("tokens_per_minute", OPENAI_TOKENS_PER_MINUTE)))
+
+
+# --- Instrumentation ---
+# Each report job collects wall time per stage and, for every OpenAI call made within a stage
+# (including from worker threads), the model, latency, retries, token usage and estimated cost.
+# The per-stage summary is stored with the report in Firestore and shown to admins; every call and
+# report summary is also appended as a JSON line to METRICS_DIR/report_metrics.jsonl, and process-wide
+# totals are written in Prometheus text format to METRICS_DIR/report_metrics.prom (for the
+# node_exporter textfile collector).
+METRICS_DIR = st.secrets.get("METRICS_DIR", os.path.join(CACHE_DIR, "metrics"))
+# Estimated prices in USD per 1M tokens: (input, cached input, output). Update when pricing changes.
+OPENAI_PRICING_PER_MILLION_TOKENS = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+LLM_METRIC_FIELDS = ["llm_calls", "cache_hits", "errors", "retries", "prompt_tokens", "cached_prompt_tokens",
+                     "completion_tokens", "cost_usd", "llm_seconds", "throttled_seconds"]
+
+# (ReportMetrics, stage name) for the stage being run in this context, or None outside report jobs
+CURRENT_METRICS = contextvars.ContextVar("current_metrics", default=None)
+
+_unpriced_models_logged = set()
+
+def get_openai_pricing(model):
+    # Prices for the model, matching dated snapshots (e.g. "gpt-4o-2024-08-06") by the longest
+    # listed prefix, or None if it isn't listed in OPENAI_PRICING_PER_MILLION_TOKENS
+    if model in OPENAI_PRICING_PER_MILLION_TOKENS:
+        return OPENAI_PRICING_PER_MILLION_TOKENS[model]
+    prefixes = [name for name in OPENAI_PRICING_PER_MILLION_TOKENS if model.startswith(name + "-")]
+    return OPENAI_PRICING_PER_MILLION_TOKENS[max(prefixes, key=len)] if prefixes else None
+
+def estimate_openai_cost(model, prompt_tokens, cached_prompt_tokens, completion_tokens):
+    pricing = get_openai_pricing(model)
+    if pricing is None:
+        if model not in _unpriced_models_logged:
+            _unpriced_models_logged.add(model)
+            print(f"DEBUG: No pricing for OpenAI model {model} in OPENAI_PRICING_PER_MILLION_TOKENS; its cost is counted as $0")
+        return 0.0
+    input_price, cached_input_price, output_price = pricing
+    return ((prompt_tokens - cached_prompt_tokens) * input_price + cached_prompt_tokens * cached_input_price
+            + completion_tokens * output_price) / 1_000_000
+
+def record_llm_call(model, seconds, cache_hit=False, error=None, retries=0, throttled_seconds=0.0,
+                    prompt_tokens=0, cached_prompt_tokens=0, completion_tokens=0):
+    # Called by get_openai_response for every request (including cache hits and failures)
+    current = CURRENT_METRICS.get()
+    if current is not None:
+        metrics, stage_name = current
+        metrics.record_llm_call(stage_name, {
+            "model": model, "seconds": seconds, "cache_hit": cache_hit, "error": error, "retries": retries,
+            "throttled_seconds": throttled_seconds, "prompt_tokens": prompt_tokens, "cached_prompt_tokens": cached_prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": estimate_openai_cost(model, prompt_tokens, cached_prompt_tokens, completion_tokens)
+        })
+
+class ReportMetrics:
+    def __init__(self, stages=None):
+        self.stages = stages or {} # Stage name -> totals; carried over from earlier runs of the same job
+        self.llm_calls = [] # Calls made by this run only (for the JSON log)
+        self.stage_runs = [] # (stage name, seconds) timed by this run only (for Prometheus)
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, dict({"seconds": 0.0}, **{field: 0 for field in LLM_METRIC_FIELDS}))
+
+    def record_stage_time(self, name, seconds):
+        with self._lock:
+            self._stage(name)["seconds"] += seconds
+            self.stage_runs.append((name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        # Times the block and attributes the OpenAI calls made inside it to stage `name`
+        token = CURRENT_METRICS.set((self, name))
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage_time(name, time.perf_counter() - started_at)
+            CURRENT_METRICS.reset(token)
+
+    def record_llm_call(self, stage_name, call):
+        with self._lock:
+            stage = self._stage(stage_name)
+            stage["llm_calls"] += 1
+            stage["cache_hits"] += int(call["cache_hit"])
+            stage["errors"] += int(call["error"] is not None)
+            stage["llm_seconds"] += call["seconds"]
+            for field in ("retries", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "cost_usd", "throttled_seconds"):
+                stage[field] += call[field]
+            self.llm_calls.append(dict(call, stage=stage_name))
+
+    def summary(self):
+        # The per-stage figures plus totals, as stored with the report
+        with self._lock:
+            stages = copy.deepcopy(self.stages)
+        totals = {field: sum(stage.get(field, 0) for stage in stages.values()) for field in ["seconds"] + LLM_METRIC_FIELDS}
+        return {"stages": stages, "totals": totals}
+
+
+class MetricsExporter:
+    # Process-wide sink for finished jobs' metrics: JSON log lines plus cumulative Prometheus counters
+    def __init__(self, directory):
+        self.directory = directory
+        self._counters = {} # (metric name, sorted label items) -> value
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _add(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def export(self, metrics, job_id, status, report_id=None):
+        timestamp = datetime.now().isoformat()
+        lines = [json.dumps(dict(call, event="llm_call", job_id=job_id)) for call in metrics.llm_calls]
+        lines.append(json.dumps(dict(metrics.summary(), event="report_metrics", job_id=job_id, report_id=report_id,
+                                     status=status, timestamp=timestamp)))
+        with self._lock:
+            with open(os.path.join(self.directory, "report_metrics.jsonl"), "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+            self._add("jdcv_reports_total", {"status": status}, 1)
+            for stage_name, seconds in metrics.stage_runs:
+                self._add("jdcv_stage_seconds_total", {"stage": stage_name}, seconds)
+                self._add("jdcv_stage_runs_total", {"stage": stage_name}, 1)
+            for call in metrics.llm_calls:
+                labels = {"stage": call["stage"], "model": call["model"]}
+                self._add("jdcv_llm_requests_total", labels, 1)
+                self._add("jdcv_llm_cache_hits_total", labels, int(call["cache_hit"]))
+                self._add("jdcv_llm_errors_total", labels, int(call["error"] is not None))
+                self._add("jdcv_llm_retries_total", labels, call["retries"])
+                self._add("jdcv_llm_request_seconds_total", labels, call["seconds"])
+                self._add("jdcv_llm_throttled_seconds_total", labels, call["throttled_seconds"])
+                self._add("jdcv_llm_cost_usd_total", labels, call["cost_usd"])
+                for token_type in ("prompt", "cached_prompt", "completion"):
+                    self._add("jdcv_llm_tokens_total", dict(labels, type=token_type), call[f"{token_type}_tokens"])
+            self._write_prometheus_file()
+
+    def _write_prometheus_file(self):
+        lines = []
+        for name in sorted({name for name, _ in self._counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric_name, labels), value in sorted(self._counters.items()):
+                if metric_name == name:
+                    label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                    lines.append(f"{name}{{{label_text}}} {value}")
+        path = os.path.join(self.directory, "report_metrics.prom")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path) # Atomic, so the collector never reads a half-written file
+
+@st.cache_resource
+def get_metrics_exporter():
+    return MetricsExporter(METRICS_DIR)
+
+# --- Pipeline Messages ---
+# Warnings and errors from the AI pipeline are shown with st.warning/st.error on the page. Report
+# jobs run outside any script run, where those calls would be dropped, so a job binds its
+# add_message here instead and the messages are shown when the page picks the job up.
+CURRENT_MESSAGE_SINK = contextvars.ContextVar("current_message_sink", default=None)
+
+def show_message(level, text):
+    # level is the name of the st function used to show the message (warning/error/...)
+    sink = CURRENT_MESSAGE_SINK.get()
+    if sink is not None:
+        sink(level, text)
+    else:
+        getattr(st, level)(text)
+
 
 # --- OpenAI/AI Functions ---
-def get_openai_response(prompt_text, json_mode=False):
-    # Use the globally initialized openai_client
+def get_openai_response(prompt_text, json_mode=False, use_cache=True, model=OPENAI_MODEL):
+    # Use the process-wide OpenAI client
+    try:
+        openai_client = load_openai_client()
+    except Exception as e:
+        print(f"DEBUG: Could not initialize the OpenAI client: Type={type(e).__name__}, Message={e}")
+        openai_client = None
     if openai_client:
         try:
             messages = [
                 {"role": "system", "content": "You are a helpful AI assistant specialized in analyzing Job Descriptions and CVs. Provide concise, direct, and actionable insights. Be professional and objective."},
                 {"role": "user", "content": prompt_text}
             ]
-            
+            request_params = {
+                "model": model,
+                "messages": messages,
+                "temperature": 0.7 # Adjust creativity
+            }
             if json_mode:
-                response = openai_client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=messages,
-                    response_format={ "type": "json_object" }, # Enable JSON mode
-                    temperature=0.7
-                )
-                return json.loads(response.choices[0].message.content) # Parse JSON
+                request_params["response_format"] = { "type": "json_object" } # Enable JSON mode
+
+            # Identical requests (same model, prompt and parameters) are answered from the local
+            # response cache unless use_cache is False. Only successful responses are cached.
+            llm_cache = get_llm_response_cache()
+            cache_key = hashlib.sha256(json.dumps(request_params, sort_keys=True).encode("utf-8")).hexdigest()
+            started_at = time.perf_counter()
+            cached_content = llm_cache.get(cache_key) if use_cache else None
+            if cached_content is not None:
+                content = cached_content.decode("utf-8")
+                record_llm_call(model, time.perf_counter() - started_at, cache_hit=True)
             else:
-                response = openai_client.chat.completions.create(
-                    model="gpt-4o", # Using a powerful model
-                    messages=messages,
-                    temperature=0.7 # Adjust creativity
-                )
-                return response.choices[0].message.content
+                # Waits for rate-limit budget and retries transient failures before giving up
+                call_stats = {}
+                try:
+                    response = get_openai_scheduler(model).call(
+                        lambda: openai_client.chat.completions.create(**request_params),
+                        estimate_tokens(messages[0]["content"] + prompt_text) + OPENAI_COMPLETION_TOKENS_ESTIMATE,
+                        call_stats=call_stats
+                    )
+                except Exception as e:
+                    record_llm_call(model, time.perf_counter() - started_at, error=type(e).__name__,
+                                    retries=call_stats.get("retries", 0), throttled_seconds=call_stats.get("throttled_seconds", 0.0))
+                    raise
+                content = response.choices[0].message.content
+                usage = getattr(response, "usage", None)
+                record_llm_call(model, time.perf_counter() - started_at,
+                                retries=call_stats["retries"], throttled_seconds=call_stats["throttled_seconds"],
+                                prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                                cached_prompt_tokens=getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0,
+                                completion_tokens=getattr(usage, "completion_tokens", 0) or 0)
+
+            result = json.loads(content) if json_mode else content # Parse JSON
+            if cached_content is None:
+                llm_cache.set(cache_key, content.encode("utf-8"))
+            return result
         except Exception as e:
             # Add a print statement to ensure it goes to console logs
             print(f"DEBUG: Caught error in get_openai_response: Type={type(e).__name__}, Message={e}")
-            st.error(f"Error calling OpenAI API: {e}. Please check your API key and network connection. If the error persists, try reducing the complexity of the prompt or input files.")
+            show_message("error", f"Error calling OpenAI API: {e}. Please check your API key and network connection. If the error persists, try reducing the complexity of the prompt or input files.")
             return "Error: Could not get response from AI." if not json_mode else {"error": "Could not get response from AI."}
     else:
-        st.error("OpenAI client not initialized. Cannot generate AI response.")
+        show_message("error", "OpenAI client not initialized. Cannot generate AI response. Please check 'OPENAI_API_KEY' in your app's secrets.")
         return "Error: OpenAI client not available." if not json_mode else {"error": "OpenAI client not available."}
 
 
 # --- NEW AI PROMPT HELPER FUNCTIONS FOR STRUCTURED DATA ---
 
-def get_candidate_evaluation_data(jd_text, cv_texts, cv_filenames):
-    evaluations = []
-    for i, cv_text in enumerate(cv_texts):
-        prompt = f"""
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # Runs each task in a copy of the submitting thread's contextvars, so per-report state such as
+    # the current metrics stage (CURRENT_METRICS) follows the work into worker threads.
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def make_thread_pool(max_workers):
+    # Worker threads inherit the current script run context so that st.warning/st.error
+    # calls made from inside them still reach the page.
+    return ContextThreadPoolExecutor(
+        max_workers=max(1, max_workers),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
+
+def run_task_graph(tasks):
+    # tasks maps a task name to (dependencies, function). Each function receives a dict with
+    # the results of its dependencies and is started as soon as all of them have finished,
+    # so independent tasks run at the same time. Returns a dict of task name -> result.
+    results = {}
+    pending = dict(tasks)
+    running = {}
+    with make_thread_pool(len(tasks)) as executor:
+        while pending or running:
+            for name, (deps, fn) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    running[executor.submit(fn, {dep: results[dep] for dep in deps})] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unresolvable task dependencies: {', '.join(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+FAILED_EVALUATION_COMMENT = "Failed to generate AI analysis."
+
+def failed_candidate_evaluation(cv_filename):
+    return {
+        "OriginalFilename": cv_filename,
+        "CandidateName": cv_filename.replace(".pdf", "").replace(".docx", ""),
+        "MatchPercent": 0,
+        "Ranking": 99,
+        "ShortlistProbability": "Low",
+        "KeyStrengths": "AI analysis failed.",
+        "KeyGaps": "AI analysis failed.",
+        "LocationSuitability": "Unknown",
+        "Comments": FAILED_EVALUATION_COMMENT
+    }
+
+def is_failed_evaluation(evaluation):
+    return evaluation.get("Comments") == FAILED_EVALUATION_COMMENT
+
+# --- JD Requirement Profile ---
+# The JD is compiled once into a compact requirement profile (must-haves, nice-to-haves, location,
+# seniority) which the candidate and criteria prompts use instead of the raw JD text, so a long JD
+# isn't paid for once per CV. Prompts still put their fixed instructions and the profile first and
+# the CV last, but no prompt-caching discount is counted on: OpenAI only caches prompts of 1,024
+# tokens or more, and the shared prefix of a profile-based prompt is usually shorter than that.
+# (cached_prompt_tokens in the report metrics shows when caching does apply.)
+JD_PROFILE_VERSION = 1 # Bump when the compilation prompt changes, so cached profiles are rebuilt
+
+def compile_jd_profile(jd_text, use_cache=True):
+    # Returns the profile dict, or None if it couldn't be compiled (callers then use the raw JD)
+    profile_cache = get_jd_profile_cache()
+    cache_key = hashlib.sha256(f"v{JD_PROFILE_VERSION}\n{jd_text}".encode("utf-8")).hexdigest()
+    cached_profile = profile_cache.get(cache_key) if use_cache else None
+    if cached_profile is not None:
+        return json.loads(cached_profile)
+
+    prompt = f"""
+        Compile the following Job Description into a compact requirement profile for screening CVs.
+        Provide the following details in a JSON object:
+        - JobTitle: The job title.
+        - Seniority: The seniority level (e.g., "Junior", "Mid-level", "Senior", "Lead"), or "Not specified".
+        - Location: The job location, including any remote, hybrid or relocation terms, or "Not specified".
+        - MustHaves: A list of short strings, one per required skill, qualification or experience (include years when stated).
+        - NiceToHaves: A list of short strings, one per preferred but optional skill or qualification.
+        - KeyResponsibilities: A list of at most 5 short strings.
+        Keep every item short and do not add requirements that are not in the Job Description.
+
+        Job Description:
+        {jd_text}
+
+        Ensure the output is a valid JSON object.
+        """
+    response = get_openai_response(prompt, json_mode=True, use_cache=False) # Cached below, by JD hash
+    if not isinstance(response, dict) or "error" in response or not isinstance(response.get("MustHaves"), list):
+        show_message("warning", "Could not compile a requirement profile for the Job Description; using the full Job Description text instead.")
+        return None
+    profile_cache.set(cache_key, json.dumps(response).encode("utf-8"))
+    return response
+
+def format_jd_profile(profile):
+    # Plain-text rendering of a compiled profile, used in place of the JD text in prompts
+    def bullet_list(items):
+        return "".join(f"\n- {item}" for item in items) if items else "\n- None stated"
+    return (
+        f"Job Title: {profile.get('JobTitle', 'Not specified')}\n"
+        f"Seniority: {profile.get('Seniority', 'Not specified')}\n"
+        f"Location: {profile.get('Location', 'Not specified')}\n"
+        f"Must-have requirements:{bullet_list(profile.get('MustHaves', []))}\n"
+        f"Nice-to-have requirements:{bullet_list(profile.get('NiceToHaves', []))}\n"
+        f"Key responsibilities:{bullet_list(profile.get('KeyResponsibilities', []))}"
+    )
+
+def evaluate_single_candidate(jd_text, cv_text, cv_filename, use_cache=True, model=OPENAI_MODEL):
+    # jd_text may be the raw JD or a formatted requirement profile (format_jd_profile). Everything
+    # up to the CV is the same for every candidate.
+    prompt = f"""
         Given the following Job Description (JD) and Candidate CV, evaluate the candidate and provide the following details in a JSON object:
         - CandidateName: Full name of the candidate (deduce from CV).
         - MatchPercent: An integer percentage (e.g., 75) indicating overall match with the JD.
@@ -567,29 +1331,142 @@ def get_candidate_evaluation_data(jd_text, cv_texts, cv_filenames):
         Job Description:
         {jd_text}
 
-        Candidate CV ({cv_filenames[i]}):
+        Candidate CV ({cv_filename}):
         {cv_text}
 
         Ensure the output is a valid JSON object.
         """
-        response = get_openai_response(prompt, json_mode=True)
-        if isinstance(response, dict) and "error" not in response:
-            # Add filename for internal tracking
-            response['OriginalFilename'] = cv_filenames[i]
-            evaluations.append(response)
-        else:
-            st.warning(f"Could not get structured evaluation for {cv_filenames[i]}: {response.get('error', 'Unknown error')}")
-            evaluations.append({
-                "CandidateName": cv_filenames[i].replace(".pdf", "").replace(".docx", ""),
-                "MatchPercent": 0,
-                "Ranking": 99,
-                "ShortlistProbability": "Low",
-                "KeyStrengths": "AI analysis failed.",
-                "KeyGaps": "AI analysis failed.",
-                "LocationSuitability": "Unknown",
-                "Comments": "Failed to generate AI analysis."
-            })
-    
+    try:
+        response = get_openai_response(prompt, json_mode=True, use_cache=use_cache, model=model)
+    except Exception as e:
+        # One bad candidate must not sink the whole batch
+        response = {"error": str(e)}
+    if isinstance(response, dict) and "error" not in response:
+        evaluation = validate_candidate_evaluation(response)
+        if evaluation is not None:
+            # Add filename for internal tracking, and the model that produced the evaluation
+            evaluation['OriginalFilename'] = cv_filename
+            evaluation['EvaluationModel'] = model
+            return evaluation
+        response = {"error": "The AI returned an incomplete or invalid evaluation."}
+    show_message("warning", f"Could not get structured evaluation for {cv_filename}: {response.get('error', 'Unknown error')}")
+    return failed_candidate_evaluation(cv_filename)
+
+EVALUATION_TEXT_FIELDS = ["CandidateName", "ShortlistProbability", "KeyStrengths", "KeyGaps", "LocationSuitability", "Comments"]
+
+def validate_candidate_evaluation(evaluation):
+    # Returns a cleaned-up copy of an AI-produced evaluation, or None if it is unusable
+    if not isinstance(evaluation, dict):
+        return None
+    if not all(isinstance(evaluation.get(field), str) and evaluation[field].strip() for field in EVALUATION_TEXT_FIELDS):
+        return None
+    try:
+        match_percent = int(float(str(evaluation.get("MatchPercent")).rstrip("%")))
+    except (ValueError, OverflowError): # e.g. "high", or "1e999" (float infinity)
+        return None
+    if not 0 <= match_percent <= 100:
+        return None
+    return dict(evaluation, MatchPercent=match_percent)
+
+def evaluate_candidate_batch(jd_text, cv_texts, cv_filenames, use_cache=True, model=OPENAI_MODEL):
+    # Evaluates several candidates in one request. Returns one entry per CV, in order: the
+    # evaluation, or None if the AI's entry for that CV was missing or failed validation
+    # (the caller falls back to evaluate_single_candidate for those).
+    prompt = f"""
+        Given the following Job Description (JD) and Candidate CVs, evaluate each candidate on their own merits and provide a JSON object
+        with a single key "Candidates": a list containing one object per CV, with the following details:
+        - CVNumber: The number of the CV, as given in its heading (e.g., 1).
+        - CandidateName: Full name of the candidate (deduce from CV).
+        - MatchPercent: An integer percentage (e.g., 75) indicating overall match with the JD.
+        - ShortlistProbability: "High", "Moderate", or "Low".
+        - KeyStrengths: A concise string listing key strengths of the CV relative to the JD.
+        - KeyGaps: A concise string listing key areas of improvement/gaps in the CV relative to the JD.
+        - LocationSuitability: "Suitable", "Consider", or "Not Suitable" (based on JD's location if specified, and CV's implied location).
+        - Comments: A concise overall comment on the candidate's fit.
+
+        Job Description:
+        {jd_text}
+
+        Candidate CVs:
+        """
+    for number, (cv_text, cv_filename) in enumerate(zip(cv_texts, cv_filenames), start=1):
+        prompt += f"\n--- CV {number} ({cv_filename}) ---\n{cv_text}\n"
+    prompt += f"\nReturn exactly {len(cv_texts)} objects in \"Candidates\". Ensure the output is a valid JSON object."
+
+    try:
+        response = get_openai_response(prompt, json_mode=True, use_cache=use_cache, model=model)
+    except Exception as e:
+        response = {"error": str(e)}
+    evaluations = [None] * len(cv_texts)
+    entries = response.get("Candidates") if isinstance(response, dict) else None
+    if not isinstance(entries, list):
+        return evaluations
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            position = int(entry.pop("CVNumber")) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        evaluation = validate_candidate_evaluation(entry)
+        if evaluation is not None and 0 <= position < len(cv_texts) and evaluations[position] is None:
+            evaluation['OriginalFilename'] = cv_filenames[position]
+            evaluation['EvaluationModel'] = model
+            evaluation.setdefault('Ranking', 1) # Re-ranked across the whole pool by the caller
+            evaluations[position] = evaluation
+    return evaluations
+
+def evaluate_candidates(jd_text, cv_texts, cv_filenames, max_workers=MAX_CONCURRENT_AI_REQUESTS, use_cache=True, on_result=None, completed=None,
+                        batch_token_budget=EVALUATION_BATCH_TOKEN_BUDGET, max_batch_size=EVALUATION_BATCH_MAX_CANDIDATES, model=OPENAI_MODEL):
+    # Candidates are evaluated concurrently (bounded by max_workers) and the results are returned in
+    # the same order as the uploaded CVs (see get_candidate_evaluation_data for the ranked list). on_result(index, evaluation), if given, is called as soon
+    # as each candidate finishes so callers can show results while the rest are still running.
+    # completed maps CV index -> evaluation for candidates already evaluated (e.g. by an earlier,
+    # partly failed run); those are reused and only the rest are sent to the AI.
+    # Pending CVs are grouped into batched requests (see evaluate_candidate_batch) sized by
+    # batch_token_budget and max_batch_size; any CV a batch doesn't return a valid evaluation for
+    # is then re-evaluated on its own.
+    completed = completed or {}
+    evaluations = [completed.get(i) for i in range(len(cv_texts))]
+    pending = [i for i, evaluation in enumerate(evaluations) if evaluation is None]
+    cv_budget = max(batch_token_budget - estimate_tokens(jd_text) - EVALUATION_PROMPT_OVERHEAD_TOKENS, 1)
+    batches = [
+        [pending[j] for j in token_batch[start:start + max(max_batch_size, 1)]]
+        for token_batch in split_into_token_batches([cv_texts[i] for i in pending], cv_budget)
+        for start in range(0, len(token_batch), max(max_batch_size, 1))
+    ]
+
+    def finish(i, evaluation):
+        evaluations[i] = evaluation
+        if on_result:
+            on_result(i, evaluation)
+
+    with make_thread_pool(min(max_workers, len(batches))) as executor:
+        def submit_single(i):
+            futures[executor.submit(evaluate_single_candidate, jd_text, cv_texts[i], cv_filenames[i], use_cache=use_cache, model=model)] = (i, None)
+
+        futures = {} # future -> (index, None) for single-candidate requests, (None, batch) for batched ones
+        for batch in batches:
+            if len(batch) == 1:
+                submit_single(batch[0])
+            else:
+                futures[executor.submit(evaluate_candidate_batch, jd_text, [cv_texts[i] for i in batch],
+                                        [cv_filenames[i] for i in batch], use_cache=use_cache, model=model)] = (None, batch)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, batch = futures.pop(future)
+                if batch is None:
+                    finish(index, future.result())
+                    continue
+                for i, evaluation in zip(batch, future.result()):
+                    if evaluation is not None:
+                        finish(i, evaluation)
+                    else:
+                        submit_single(i) # Fall back to a single-candidate request for entries the batch didn't cover
+    return evaluations
+
+def rank_candidate_evaluations(evaluations):
     # After getting individual evaluations, re-rank them globally based on MatchPercent
     if evaluations:
         evaluations.sort(key=lambda x: x.get('MatchPercent', 0), reverse=True)
@@ -605,8 +1482,93 @@ def get_candidate_evaluation_data(jd_text, cv_texts, cv_filenames):
     
     return evaluations
 
+def get_candidate_evaluation_data(jd_text, cv_texts, cv_filenames, **kwargs):
+    # Evaluates every candidate with one model (see evaluate_candidates for the options) and ranks them
+    return rank_candidate_evaluations(evaluate_candidates(jd_text, cv_texts, cv_filenames, **kwargs))
+
+def get_tiered_candidate_evaluation_data(jd_text, cv_texts, cv_filenames, escalation_band=ESCALATION_MATCH_BAND,
+                                         on_result=None, completed=None, on_escalation=None, **kwargs):
+    # Model cascade: every candidate is first scored with OPENAI_SCREENING_MODEL, and only those whose
+    # MatchPercent falls within escalation_band (inclusive), plus any whose screening failed, are
+    # re-evaluated with OPENAI_MODEL. Each evaluation's EvaluationModel records which tier produced it.
+    # on_result sees screening results too; a screening result inside the band that was checkpointed
+    # by an earlier run (in completed) is still escalated. on_escalation(indices), if given, is called
+    # with the CV indices being re-evaluated before the second pass starts.
+    low, high = escalation_band
+    screened = evaluate_candidates(jd_text, cv_texts, cv_filenames, model=OPENAI_SCREENING_MODEL,
+                                   on_result=on_result, completed=completed, **kwargs)
+    final_evaluations = {
+        i: evaluation for i, evaluation in enumerate(screened)
+        if not is_failed_evaluation(evaluation)
+        and not (evaluation.get('EvaluationModel') == OPENAI_SCREENING_MODEL and low <= evaluation.get('MatchPercent', 0) <= high)
+    }
+    if on_escalation:
+        on_escalation([i for i in range(len(cv_texts)) if i not in final_evaluations])
+    evaluations = evaluate_candidates(jd_text, cv_texts, cv_filenames, model=OPENAI_MODEL,
+                                      on_result=on_result, completed=final_evaluations, **kwargs)
+    return rank_candidate_evaluations(evaluations)
+
+
+def estimate_tokens(text):
+    # Rough token count (~4 characters per token for English text); good enough for budgeting prompts
+    return len(text) // 4 + 1
+
+def split_into_token_batches(texts, token_budget):
+    # Greedily groups text indices so each group's estimated token total stays within token_budget.
+    # A single text larger than the budget still gets a group of its own.
+    batches = []
+    current_batch, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current_batch and current_tokens + tokens > token_budget:
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(i)
+        current_tokens += tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+def get_criteria_comparison_data(jd_text, cv_texts, cv_filenames, criteria_list, use_cache=True,
+                                 token_budget=CRITERIA_PROMPT_TOKEN_BUDGET, max_workers=MAX_CONCURRENT_AI_REQUESTS,
+                                 completed_batches=None, on_batch_result=None):
+    # Map-reduce over the candidate pool: CVs are split into groups whose prompt (JD + CVs) fits
+    # token_budget, the groups are compared concurrently, and the per-criterion ratings are merged
+    # back into a single {criterion: {candidate: emoji}} dict. Small pools still use one request.
+    # Each group is identified by its CV indices ("0,1,2"): completed_batches maps that key to a
+    # result from an earlier run, which is reused, and on_batch_result(key, result) is called as
+    # each new group finishes (result is None if the AI call failed).
+    completed_batches = completed_batches or {}
+    cv_budget = max(token_budget - estimate_tokens(jd_text) - CRITERIA_PROMPT_OVERHEAD_TOKENS, 1)
+    batches = split_into_token_batches(cv_texts, cv_budget)
+
+    def compare_batch(batch):
+        batch_key = ",".join(str(i) for i in batch)
+        if batch_key in completed_batches:
+            return completed_batches[batch_key]
+        batch_result = get_criteria_comparison_batch(
+            jd_text, [cv_texts[i] for i in batch], [cv_filenames[i] for i in batch], criteria_list, use_cache=use_cache
+        )
+        if on_batch_result:
+            on_batch_result(batch_key, batch_result)
+        return batch_result
+
+    with make_thread_pool(min(max_workers, len(batches))) as executor:
+        batch_results = list(executor.map(compare_batch, batches))
+
+    merged = {}
+    for batch, batch_result in zip(batches, batch_results):
+        if batch_result is None:
+            # Fallback for a failed group, so the candidates still get a column in the table
+            batch_result = {criterion: {cv_filenames[i].replace('.pdf','').replace('.docx',''): "N/A" for i in batch} for criterion in criteria_list}
+        for criterion, candidate_ratings in batch_result.items():
+            if isinstance(candidate_ratings, dict):
+                merged.setdefault(criterion, {}).update(candidate_ratings)
+            else:
+                merged.setdefault(criterion, candidate_ratings)
+    return merged
 
-def get_criteria_comparison_data(jd_text, cv_texts, cv_filenames, criteria_list):
+def get_criteria_comparison_batch(jd_text, cv_texts, cv_filenames, criteria_list, use_cache=True):
     # This prompt asks the AI to evaluate each candidate against a fixed set of criteria
     # and provide a simple emoji-based rating.
     prompt = f"""
@@ -619,23 +1581,26 @@ def get_criteria_comparison_data(jd_text, cv_texts, cv_filenames, criteria_list)
 
     Job Description:
     {jd_text}
-
-    Candidate CVs:
     """
-    for i, cv_text in enumerate(cv_texts):
-        prompt += f"\n--- CV {cv_filenames[i]} ---\n{cv_text}\n"
-
+    # Criteria go before the CVs so that every batch for this report shares the same prompt prefix
+    # (which OpenAI only caches once the prompt reaches 1,024 tokens)
     prompt += f"\nCriteria to evaluate (use these exact names as keys): {', '.join(criteria_list)}"
     prompt += "\nExample JSON structure: {'Education (MBA)': {'Candidate1 Name': '✅', 'Candidate2 Name': '⚠️'}, 'Relevant Experience': {'Candidate1 Name': '❌', 'Candidate2 Name': '✅'}}"
 
-    response = get_openai_response(prompt, json_mode=True)
+    prompt += "\n\nCandidate CVs:\n"
+    for i, cv_text in enumerate(cv_texts):
+        prompt += f"\n--- CV {cv_filenames[i]} ---\n{cv_text}\n"
+
+    response = get_openai_response(prompt, json_mode=True, use_cache=use_cache)
     if isinstance(response, dict) and "error" not in response:
         return response
     else:
-        st.warning(f"Could not get structured criteria comparison: {response.get('error', 'Unknown error')}")
-        return {criterion: {filename.replace('.pdf','').replace('.docx',''): "❌" for filename in cv_filenames} for criterion in criteria_list} # Fallback
+        show_message("warning", f"Could not get structured criteria comparison: {response.get('error', 'Unknown error')}")
+        return None # The caller fills in fallback ratings
+
+FAILED_OBSERVATIONS_TEXT = "Could not generate general observations."
 
-def get_general_observations_and_shortlist(evaluations):
+def get_general_observations_and_shortlist(evaluations, use_cache=True):
     # Sort candidates by ranking to feed into the prompt correctly
     sorted_candidates = sorted(evaluations, key=lambda x: x.get('Ranking', 99))
 
@@ -648,118 +1613,764 @@ def get_general_observations_and_shortlist(evaluations):
     
     prompt += "\nOutput in JSON format with keys 'GeneralObservations' (string) and 'ShortlistedCandidates' (list of strings)."
 
-    response = get_openai_response(prompt, json_mode=True)
+    response = get_openai_response(prompt, json_mode=True, use_cache=use_cache)
     if isinstance(response, dict) and "error" not in response:
         return response
     else:
-        st.warning(f"Could not get general observations and shortlist: {response.get('error', 'Unknown error')}")
-        return {"GeneralObservations": "Could not generate general observations.", "ShortlistedCandidates": []}
-
-
-# --- Report Generation Function (MODIFIED FOR NEW FORMAT) ---
-def create_comparative_docx_report(jd_text, cv_texts, report_data, candidate_evaluations, criteria_comparison_data, general_and_shortlist_data):
-    document = Document()
-
-    document.add_heading('JD-CV Comparative Analysis Report', level=1)
-    
-    # Add a paragraph for general info
-    document.add_paragraph(f"Generated by {report_data.get('generated_by_username', report_data.get('generated_by_email'))}")
-    document.add_paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    document.add_paragraph(f"Job Description: {report_data.get('jd_filename', 'N/A')}")
-    document.add_paragraph(f"Candidates: {', '.join(report_data.get('cv_filenames', ['N/A']))}")
-    
-    document.add_page_break()
-
-    # --- Candidate Evaluation Table ---
-    document.add_heading('🧾 Candidate Evaluation Table', level=2)
-    document.add_paragraph('Detailed assessment of each candidate against the Job Description:')
-
-    if candidate_evaluations:
-        headers = ["Candidate Name", "Match %", "Ranking", "Shortlist Probability", "Key Strengths", "Key Gaps", "Location Suitability", "Comments"]
-        table = document.add_table(rows=1, cols=len(headers))
-        table.style = 'Table Grid'
-
-        # Add header row
-        hdr_cells = table.rows[0].cells
-        for i, header_text in enumerate(headers):
-            hdr_cells[i].text = header_text
-            hdr_cells[i].paragraphs[0].runs[0].font.bold = True
-            hdr_cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
-            hdr_cells[i].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-
-        # Add data rows
-        for candidate in candidate_evaluations:
-            row_cells = table.add_row().cells
-            row_cells[0].text = candidate.get('CandidateName', 'N/A')
-            row_cells[1].text = f"{candidate.get('MatchPercent', 0)}%"
-            row_cells[2].text = str(candidate.get('Ranking', 'N/A'))
-            row_cells[3].text = candidate.get('ShortlistProbability', 'N/A')
-            row_cells[4].text = candidate.get('KeyStrengths', 'N/A')
-            row_cells[5].text = candidate.get('KeyGaps', 'N/A')
-            row_cells[6].text = candidate.get('LocationSuitability', 'N/A')
-            row_cells[7].text = candidate.get('Comments', 'N/A')
-    else:
-        document.add_paragraph("No candidate evaluation data available.")
+        show_message("warning", f"Could not get general observations and shortlist: {response.get('error', 'Unknown error')}")
+        return {"GeneralObservations": FAILED_OBSERVATIONS_TEXT, "ShortlistedCandidates": []}
+
+
+# --- Local Pre-screening (no AI calls) ---
+PRESCREEN_TOKEN_PATTERN = re.compile(r"[a-z0-9+#]+")
+
+def prescreen_candidates(jd_text, cv_texts):
+    # Scores every CV against the JD locally with TF-IDF cosine similarity (0.0-1.0), so large
+    # pools can be narrowed down before any OpenAI call. The document-term matrix is kept in
+    # sparse (document, term, count) form and all weighting is vectorized with NumPy.
+    import numpy as np
+    vocabulary = {}
+    doc_ids, term_ids = [], []
+    for doc_id, text in enumerate([jd_text] + list(cv_texts)):
+        ids = [vocabulary.setdefault(token, len(vocabulary)) for token in PRESCREEN_TOKEN_PATTERN.findall(text.lower())]
+        term_ids.append(np.asarray(ids, dtype=np.int64))
+        doc_ids.append(np.full(len(ids), doc_id, dtype=np.int64))
+    num_docs, vocab_size = len(cv_texts) + 1, len(vocabulary)
+    if vocab_size == 0:
+        return np.zeros(len(cv_texts))
+
+    # Unique (document, term) pairs and their term counts
+    pair_keys, counts = np.unique(np.concatenate(doc_ids) * vocab_size + np.concatenate(term_ids), return_counts=True)
+    pair_docs, pair_terms = np.divmod(pair_keys, vocab_size)
+
+    # Sublinear TF with smoothed IDF, then cosine similarity of every CV against the JD (document 0)
+    doc_freq = np.bincount(pair_terms, minlength=vocab_size)
+    idf = np.log((1 + num_docs) / (1 + doc_freq)) + 1
+    weights = (1 + np.log(counts)) * idf[pair_terms]
+    norms = np.sqrt(np.bincount(pair_docs, weights=weights ** 2, minlength=num_docs))
+    jd_vector = np.zeros(vocab_size)
+    jd_vector[pair_terms[pair_docs == 0]] = weights[pair_docs == 0]
+    dots = np.bincount(pair_docs, weights=weights * jd_vector[pair_terms], minlength=num_docs)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarities = dots / (norms * norms[0])
+    return np.nan_to_num(similarities[1:])
+
+def select_prescreened_candidates(scores, top_k=None, min_score=None):
+    # Returns the indices (in upload order) of the CVs that pass the pre-screen:
+    # those scoring at least min_score, capped at the top_k best.
+    import numpy as np
+    order = np.argsort(-scores, kind="stable")
+    if min_score is not None:
+        order = order[scores[order] >= min_score]
+    if top_k:
+        order = order[:top_k]
+    return sorted(order.tolist())
+
+
+# --- Report Storage (Firestore) ---
+# A report is stored as a small summary document in 'reports' (metadata, counts, top candidates)
+# plus its detail in subcollections: one document per candidate evaluation in 'candidates' and
+# the criteria matrix, observations/shortlist and pre-screen scores in 'details'. Listings read
+# only summaries, and large candidate pools stay far below Firestore's 1 MiB document limit.
+# Reports saved before this layout (storage_version missing) keep everything inline.
+REPORT_STORAGE_VERSION = 2
+REPORT_TOP_CANDIDATES = 5 # Candidates summarised on the report document itself
+FIRESTORE_BATCH_SIZE = 400 # Writes per batch (Firestore allows at most 500)
+
+def save_report(report_data, report_id=None):
+    # Writes the detail documents first and the summary last, so a report only shows up in
+    # listings once it is complete. Returns the report's ID. Saving again under the same report_id
+    # overwrites the report (so a resumed job doesn't add a duplicate); without one a new ID is used.
+    db = load_firestore_client()
+    report_ref = db.collection('reports').document(report_id)
+    candidate_evaluations = report_data.get('candidate_evaluations', [])
+    general_and_shortlist_data = report_data.get('general_and_shortlist_data', {})
+
+    detail_writes = [
+        (report_ref.collection('candidates').document(f"{i:05d}"), dict(evaluation, index=i))
+        for i, evaluation in enumerate(candidate_evaluations)
+    ]
+    detail_writes.append((report_ref.collection('details').document('criteria_comparison'), {'data': report_data.get('criteria_comparison_data', {})}))
+    detail_writes.append((report_ref.collection('details').document('general_and_shortlist'), {'data': general_and_shortlist_data}))
+    detail_writes.append((report_ref.collection('details').document('prescreen'), {'data': report_data.get('prescreen_results', [])}))
+    for start in range(0, len(detail_writes), FIRESTORE_BATCH_SIZE):
+        batch = db.batch()
+        for doc_ref, doc_data in detail_writes[start:start + FIRESTORE_BATCH_SIZE]:
+            batch.set(doc_ref, doc_data)
+        batch.commit()
+
+    summary = {key: value for key, value in report_data.items()
+               if key not in ('candidate_evaluations', 'criteria_comparison_data', 'general_and_shortlist_data', 'prescreen_results')}
+    ranked_candidates = sorted(candidate_evaluations, key=lambda x: x.get('Ranking', 99))
+    summary.update({
+        'storage_version': REPORT_STORAGE_VERSION,
+        'content_hash': report_content_hash(report_data),
+        'candidate_count': len(candidate_evaluations),
+        'top_candidates': [
+            {'CandidateName': c.get('CandidateName', 'N/A'), 'MatchPercent': c.get('MatchPercent', 0)}
+            for c in ranked_candidates[:REPORT_TOP_CANDIDATES]
+        ],
+        'shortlisted_candidates': general_and_shortlist_data.get('ShortlistedCandidates', [])
+    })
+    report_ref.set(summary)
+    return report_ref.id
+
+def load_report_data(report_id):
+    # Full report (summary plus candidate evaluations, criteria and observations) in the same
+    # shape as it was generated, or {} if the report is gone
+    report_ref = load_firestore_client().collection('reports').document(report_id)
+    report_doc = report_ref.get()
+    if not report_doc.exists:
+        return {}
+    report_data = report_doc.to_dict()
+    if report_data.get('storage_version', 1) < 2:
+        return report_data # Legacy report with everything inline
+
+    report_data['candidate_evaluations'] = []
+    for candidate_doc in report_ref.collection('candidates').order_by('index').stream():
+        evaluation = candidate_doc.to_dict()
+        evaluation.pop('index', None)
+        report_data['candidate_evaluations'].append(evaluation)
+    details = {doc.id: doc.to_dict().get('data') for doc in report_ref.collection('details').stream()}
+    report_data['criteria_comparison_data'] = details.get('criteria_comparison') or {}
+    report_data['general_and_shortlist_data'] = details.get('general_and_shortlist') or {}
+    report_data['prescreen_results'] = details.get('prescreen') or []
+    return report_data
+
+# Everything create_comparative_docx_report renders from; a rendered document stays valid for
+# as long as the hash of these fields is unchanged
+REPORT_RENDER_FIELDS = ['generated_by_username', 'generated_by_email', 'jd_filename', 'cv_filenames', 'candidate_evaluations',
+                        'criteria_comparison_data', 'general_and_shortlist_data', 'prescreen_results', 'escalation_band', 'failed_steps']
+
+def report_content_hash(report_data):
+    render_inputs = {field: report_data.get(field) for field in REPORT_RENDER_FIELDS}
+    return hashlib.sha256(json.dumps(render_inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def report_docx_cache_key(report_id, content_hash):
+    return f"{report_id}-{content_hash}"
+
+def update_report_drive_status(report_id, status, drive_file_id=None):
+    # Called by the Drive uploader once an upload has finished (or given up)
+    updates = {'drive_upload_status': status}
+    if drive_file_id:
+        updates['drive_file_id'] = drive_file_id
+    load_firestore_client().collection('reports').document(report_id).update(updates)
+
+def delete_report(report_id):
+    # Deletes the summary document and its detail subcollections
+    db = load_firestore_client()
+    report_ref = db.collection('reports').document(report_id)
+    doc_refs = [doc.reference for name in ('candidates', 'details') for doc in report_ref.collection(name).stream()]
+    doc_refs.append(report_ref)
+    for start in range(0, len(doc_refs), FIRESTORE_BATCH_SIZE):
+        batch = db.batch()
+        for doc_ref in doc_refs[start:start + FIRESTORE_BATCH_SIZE]:
+            batch.delete(doc_ref)
+        batch.commit()
+
+# --- Background Google Drive Uploads ---
+# Drive uploads run on a background thread so report generation never waits on Drive. Each queued
+# upload is persisted under DRIVE_UPLOAD_QUEUE_DIR as <upload_id>.docx plus <upload_id>.json (file
+# name, report ID, attempts, next attempt time), so pending uploads survive restarts. Files are sent
+# in resumable chunks; failures are retried with jittered exponential backoff, and once an upload
+# succeeds the report's drive_file_id is backfilled in Firestore. Entries that were given up on, and
+# unreadable ones (set aside as <upload_id>.json.bad), are deleted after
+# DRIVE_UPLOAD_FAILED_RETENTION_SECONDS, since the .docx holds the whole CV-derived report.
+DRIVE_UPLOAD_QUEUE_DIR = os.path.join(CACHE_DIR, "drive_uploads")
+DRIVE_UPLOAD_CHUNK_BYTES = 1024 * 1024 # Must be a multiple of 256 KiB
+DRIVE_UPLOAD_MAX_ATTEMPTS = 8
+DRIVE_UPLOAD_BASE_DELAY_SECONDS = 5
+DRIVE_UPLOAD_MAX_DELAY_SECONDS = 15 * 60
+DRIVE_UPLOAD_FAILED_RETENTION_SECONDS = 3600 * float(st.secrets.get("DRIVE_UPLOAD_FAILED_RETENTION_HOURS", 72))
+
+class DriveUploader:
+    def __init__(self):
+        os.makedirs(DRIVE_UPLOAD_QUEUE_DIR, exist_ok=True)
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="drive-uploader", daemon=True)
+        self._thread.start()
+
+    def _entry_path(self, upload_id, extension):
+        return os.path.join(DRIVE_UPLOAD_QUEUE_DIR, f"{upload_id}.{extension}")
+
+    def _write_entry(self, entry):
+        path = self._entry_path(entry['upload_id'], "json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+
+    def enqueue(self, report_id, file_name, report_bytes):
+        upload_id = uuid.uuid4().hex
+        with open(self._entry_path(upload_id, "docx"), "wb") as f:
+            f.write(report_bytes)
+        # The .json is written last: an entry without it is incomplete and never picked up
+        self._write_entry({
+            'upload_id': upload_id, 'report_id': report_id, 'file_name': file_name,
+            'drive_file_id': None, 'attempts': 0, 'next_attempt_at': 0, 'last_error': None
+        })
+        self._wake.set()
+        return upload_id
 
-    document.add_page_break()
+    def _run(self):
+        while True:
+            try:
+                wait_seconds = self._process_due_entries()
+            except Exception as e:
+                print(f"DEBUG: Drive uploader error: Type={type(e).__name__}, Message={e}")
+                wait_seconds = 60
+            self._wake.wait(timeout=wait_seconds)
+            self._wake.clear()
+
+    def _process_due_entries(self):
+        # Handles every entry whose next attempt is due; returns how long to sleep until the next one.
+        # A broken entry is set aside on its own, so it can't hold up the entries after it.
+        wait_seconds = 60
+        for file_name in sorted(os.listdir(DRIVE_UPLOAD_QUEUE_DIR)):
+            path = os.path.join(DRIVE_UPLOAD_QUEUE_DIR, file_name)
+            try:
+                if file_name.endswith(".json"):
+                    wait_seconds = min(wait_seconds, self._process_entry(path))
+                elif file_name.endswith(".json.bad") and self._failed_entry_expired(path):
+                    self._remove_entry_files(file_name[:-len(".json.bad")])
+            except Exception as e:
+                print(f"DEBUG: Setting aside Drive upload queue entry {file_name}: Type={type(e).__name__}, Message={e}")
+                self._set_aside(path)
+        return max(wait_seconds, 1)
+
+    def _process_entry(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        if entry.get('failed'):
+            if self._failed_entry_expired(path): # The .json isn't rewritten once an entry has failed
+                self._remove_entry_files(entry['upload_id'])
+            return 60
+        now = time.time()
+        if entry['next_attempt_at'] > now:
+            return entry['next_attempt_at'] - now
+        self._attempt(entry)
+        return 60
+
+    @staticmethod
+    def _failed_entry_expired(path):
+        return time.time() - os.path.getmtime(path) > DRIVE_UPLOAD_FAILED_RETENTION_SECONDS
+
+    def _set_aside(self, path):
+        if not path.endswith(".json"):
+            return
+        try:
+            os.replace(path, path + ".bad")
+            os.utime(path + ".bad") # Its retention period starts now
+        except OSError as e:
+            print(f"DEBUG: Could not set aside Drive upload queue entry {path}: {e}")
+
+    def _remove_entry_files(self, upload_id):
+        # Also completes a half-removed entry
+        for extension in ("json", "json.bad", "docx"):
+            try:
+                os.remove(self._entry_path(upload_id, extension))
+            except FileNotFoundError:
+                pass
 
-    # --- Criteria Comparison Table ---
-    document.add_heading('✅ Additional Observations (Criteria Comparison)', level=2)
+    def _attempt(self, entry):
+        try:
+            if not entry['drive_file_id']:
+                entry['drive_file_id'] = self._upload(entry)
+                self._write_entry(entry) # Never upload twice if only the backfill below fails
+            if entry['report_id']:
+                update_report_drive_status(entry['report_id'], 'uploaded', entry['drive_file_id'])
+        except Exception as e:
+            entry['attempts'] += 1
+            entry['last_error'] = f"{type(e).__name__}: {e}"
+            if entry['attempts'] >= DRIVE_UPLOAD_MAX_ATTEMPTS:
+                entry['failed'] = True # Kept on disk for inspection, no longer retried
+                print(f"DEBUG: Giving up on Drive upload {entry['upload_id']} ({entry['file_name']}): {entry['last_error']}")
+                if entry['report_id']:
+                    try:
+                        update_report_drive_status(entry['report_id'], 'failed')
+                    except Exception:
+                        pass
+            else:
+                delay = min(DRIVE_UPLOAD_MAX_DELAY_SECONDS, DRIVE_UPLOAD_BASE_DELAY_SECONDS * 2 ** entry['attempts'])
+                entry['next_attempt_at'] = time.time() + delay * random.uniform(0.5, 1.0) # Jitter
+            self._write_entry(entry)
+            return
+        self._remove_entry_files(entry['upload_id'])
+
+    def _upload(self, entry):
+        from googleapiclient.http import MediaFileUpload
+        file_metadata = {
+            'name': entry['file_name'],
+            'parents': [GOOGLE_DRIVE_REPORTS_FOLDER_ID],
+            'mimeType': DOCX_MIME_TYPE
+        }
+        media = MediaFileUpload(self._entry_path(entry['upload_id'], "docx"), mimetype=DOCX_MIME_TYPE,
+                                chunksize=DRIVE_UPLOAD_CHUNK_BYTES, resumable=True)
+        request = load_drive_service().files().create(body=file_metadata, media_body=media, fields='id')
+        response = None
+        while response is None:
+            # Each chunk is retried in place (same resumable session) before the whole attempt fails
+            _, response = request.next_chunk(num_retries=3)
+        return response['id']
+
+@st.cache_resource
+def get_drive_uploader():
+    # One uploader thread per server process; starting it also resumes uploads queued before a restart
+    return DriveUploader()
+
+def download_drive_file(file_id):
+    from googleapiclient.http import MediaIoBaseDownload
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, load_drive_service().files().get_media(fileId=file_id), chunksize=DRIVE_UPLOAD_CHUNK_BYTES)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk(num_retries=3)
+    return buffer.getvalue()
+
+def get_report_docx_bytes(report_id, content_hash=None, drive_file_id=None):
+    # Serves a saved report's DOCX from, in order: the local disk cache, the report's Google Drive
+    # copy, or a fresh render from the stored report data. Drive copies and renders are cached, so
+    # repeat downloads are just a file read. Returns (docx_bytes, source) where source is
+    # 'cache', 'drive' or 'rendered'.
+    cache = get_report_docx_cache()
+    report_data = None
+    if content_hash is None: # Reports saved before content hashes were stored
+        report_data = load_report_data(report_id)
+        content_hash = report_content_hash(report_data)
+    cache_key = report_docx_cache_key(report_id, content_hash)
+
+    docx_bytes = cache.get(cache_key)
+    if docx_bytes is not None:
+        return docx_bytes, "cache"
+
+    if drive_file_id:
+        # The Drive copy was uploaded from the same rendered bytes when the report was generated
+        try:
+            docx_bytes = download_drive_file(drive_file_id)
+            cache.set(cache_key, docx_bytes)
+            return docx_bytes, "drive"
+        except Exception as e:
+            print(f"DEBUG: Could not fetch report {report_id} from Google Drive, re-rendering: Type={type(e).__name__}, Message={e}")
+
+    if report_data is None:
+        report_data = load_report_data(report_id)
+    docx_bytes = create_comparative_docx_report(
+        "", [], report_data, # JD/CV texts aren't stored with the report and aren't used by the renderer
+        report_data.get('candidate_evaluations', []),
+        report_data.get('criteria_comparison_data', {}),
+        report_data.get('general_and_shortlist_data', {})
+    ).getvalue()
+    cache.set(cache_key, docx_bytes)
+    return docx_bytes, "rendered"
+
+# --- Background Report Jobs ---
+# Report generation runs on a process-wide worker pool instead of inside the Streamlit script run,
+# so a browser refresh or dropped websocket no longer throws the LLM work away. Each job keeps its
+# inputs, progress and per-stage results under REPORT_JOBS_DIR/<job_id>/; the page reattaches to
+# a job by ID, and a job interrupted by a server restart resumes without re-running finished stages.
+REPORT_JOBS_DIR = os.path.join(CACHE_DIR, "report_jobs")
+MAX_CONCURRENT_REPORT_JOBS = 4
+REPORT_JOB_POLL_SECONDS = 2
+ACTIVE_JOB_STATUSES = ("queued", "running")
+# Job directories hold the uploaded JD/CV text, so jobs untouched for this long are deleted
+# (a finished report is kept in Firestore/Drive; a failed one can be retried until then)
+REPORT_JOB_RETENTION_SECONDS = 3600 * float(st.secrets.get("REPORT_JOB_RETENTION_HOURS", 72))
+REPORT_JOB_PRUNE_INTERVAL_SECONDS = 3600
+
+class ReportJob:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.directory = os.path.join(REPORT_JOBS_DIR, job_id)
+        self._lock = threading.Lock()
+        self.state = self._read_json("state.json") or {}
+
+    def _read_json(self, name):
+        try:
+            with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path) # Atomic, so a crash never leaves a half-written state file
+
+    def save_inputs(self, inputs):
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_json("inputs.json", inputs)
+
+    def load_inputs(self):
+        return self._read_json("inputs.json")
+
+    def snapshot(self):
+        with self._lock:
+            return copy.deepcopy(self.state)
+
+    def update(self, **fields):
+        with self._lock:
+            self.state.update(fields, updated_at=datetime.now().isoformat())
+            self._write_json("state.json", self.state)
+
+    def save_stage(self, name, result):
+        with self._lock:
+            self.state.setdefault("stages", {})[name] = result
+            self._write_json("state.json", self.state)
+
+    def add_message(self, level, text):
+        # level is the name of the st function used to show the message (success/warning/error)
+        with self._lock:
+            self.state.setdefault("messages", []).append([level, text])
+            self._write_json("state.json", self.state)
+
+    def record_candidate_result(self, index, evaluation):
+        with self._lock:
+            self.state.setdefault("candidate_results", {})[str(index)] = evaluation
+            self._write_json("state.json", self.state)
+
+    def record_checkpoint(self, group, key, result):
+        # Finished unit of work inside a stage (e.g. one criteria comparison batch), kept for retries
+        with self._lock:
+            self.state.setdefault("checkpoints", {}).setdefault(group, {})[key] = result
+            self._write_json("state.json", self.state)
+
+    def write_report(self, report_bytes):
+        with open(os.path.join(self.directory, "report.docx"), "wb") as f:
+            f.write(report_bytes)
+
+    def read_report(self):
+        try:
+            with open(os.path.join(self.directory, "report.docx"), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+class ReportJobManager:
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-job")
+        self._jobs = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._last_pruned_at = 0.0
+        os.makedirs(REPORT_JOBS_DIR, exist_ok=True)
+        self._prune_expired_jobs()
+
+    def _prune_expired_jobs(self):
+        # Runs when the manager starts and then at most once per REPORT_JOB_PRUNE_INTERVAL_SECONDS.
+        # A job's age is taken from its last state update; jobs running in this process are kept.
+        now = time.time()
+        with self._lock:
+            if now - self._last_pruned_at < REPORT_JOB_PRUNE_INTERVAL_SECONDS:
+                return
+            self._last_pruned_at = now
+            for job_id in os.listdir(REPORT_JOBS_DIR):
+                directory = os.path.join(REPORT_JOBS_DIR, job_id)
+                if job_id in self._running or not os.path.isdir(directory):
+                    continue
+                state_path = os.path.join(directory, "state.json")
+                try:
+                    last_updated_at = os.path.getmtime(state_path if os.path.exists(state_path) else directory)
+                except OSError:
+                    continue
+                if now - last_updated_at > REPORT_JOB_RETENTION_SECONDS:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    self._jobs.pop(job_id, None)
+
+    def submit(self, inputs, owner_email):
+        self._prune_expired_jobs()
+        job = ReportJob(uuid.uuid4().hex)
+        job.save_inputs(inputs)
+        job.update(
+            job_id=job.job_id, owner_email=owner_email, status="queued", progress=0.0,
+            message="Waiting for a free worker...", stages={}, messages=[], created_at=datetime.now().isoformat(),
+            candidate_filenames=inputs["cv_filenames"], candidate_results={}, tiered_evaluation=bool(inputs.get("escalation_band"))
+        )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._start_locked(job)
+        return job.job_id
+
+    def get(self, job_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+            return None
+        self._prune_expired_jobs()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = ReportJob(job_id)
+                if not job.state:
+                    return None
+                self._jobs[job_id] = job
+            # A job left queued/running by an earlier server process is picked up again here
+            if job.state.get("status") in ACTIVE_JOB_STATUSES and job_id not in self._running:
+                job.update(message="Resuming interrupted report generation...")
+                self._start_locked(job)
+        return job
+
+    def retry(self, job_id, allow_partial_results=False):
+        # Re-runs a failed job. Finished stages, candidates and criteria batches are reused from
+        # its checkpoints, so only the units that failed are sent to the AI again. With
+        # allow_partial_results, units that fail again no longer stop the job: the report is
+        # generated with them marked as failed (for failures a retry won't fix).
+        job = self.get(job_id)
+        if job is None:
+            return False
+        with self._lock:
+            if job.state.get("status") != "failed" or job_id in self._running:
+                return False
+            successful_results = {i: evaluation for i, evaluation in job.state.get("candidate_results", {}).items()
+                                  if not is_failed_evaluation(evaluation)}
+            job.update(status="queued", error=None, message="Retrying the failed steps...", candidate_results=successful_results,
+                       allow_partial_results=allow_partial_results)
+            self._start_locked(job)
+        return True
+
+    def _start_locked(self, job):
+        self._running.add(job.job_id)
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        # Pipeline warnings/errors are kept with the job (these threads have no script run to show them in)
+        message_sink_token = CURRENT_MESSAGE_SINK.set(job.add_message)
+        try:
+            run_report_job(job)
+        except Exception as e:
+            print(f"DEBUG: Report job {job.job_id} failed: Type={type(e).__name__}, Message={e}")
+            job.update(status="failed", error=f"An unexpected error occurred during report generation: {e}")
+        finally:
+            CURRENT_MESSAGE_SINK.reset(message_sink_token)
+            with self._lock:
+                self._running.discard(job.job_id)
+
+@st.cache_resource
+def get_report_job_manager():
+    # Shared by every session in this server process
+    return ReportJobManager(MAX_CONCURRENT_REPORT_JOBS)
+
+def run_report_job(job):
+    inputs = job.load_inputs()
+    jd_text = inputs["jd_text"]
+    cv_texts = inputs["cv_texts"]
+    cv_filenames = inputs["cv_filenames"]
+    use_cache = inputs["use_cache"]
+    job_state = job.snapshot()
+    stages = job_state.get("stages", {})
+    checkpoints = job_state.get("checkpoints", {})
+    allow_partial_results = job_state.get("allow_partial_results", False)
+    job.update(status="running", progress=0.05, message="Evaluating candidates and comparing criteria...",
+               escalating_candidates=None, escalated_candidates=[])
+
+    # Timings and LLM usage per stage, accumulated across runs of this job (a retry adds to them)
+    metrics = ReportMetrics(job_state.get("metrics"))
+    for stage_name, seconds in inputs.get("page_timings", {}).items(): # Document extraction etc., timed on the page
+        if stage_name not in metrics.stages:
+            metrics.record_stage_time(stage_name, seconds)
+
+    def export_metrics(status, report_id=None):
+        job.update(metrics=metrics.summary()["stages"])
+        try:
+            get_metrics_exporter().export(metrics, job.job_id, status, report_id)
+        except Exception as e:
+            print(f"DEBUG: Could not export metrics for report job {job.job_id}: Type={type(e).__name__}, Message={e}")
+
+    def generate_report():
+        def run_stage(name, message, fn, succeeded=lambda result: True):
+            # Stages completed by an earlier run of this job (interrupted, or failed elsewhere) are
+            # reused instead of paid for twice. A stage is only checkpointed once it has succeeded.
+            if name in stages:
+                return stages[name]
+            job.update(message=message)
+            with metrics.stage(name):
+                result = fn()
+            job.update(metrics=metrics.summary()["stages"])
+            if succeeded(result):
+                job.save_stage(name, result)
+                job.update(progress=0.05 + 0.8 * len(job.snapshot()["stages"]) / 6)
+            return result
+
+        # Within Steps 1 and 2 each candidate evaluation and each criteria batch is checkpointed as
+        # soon as it succeeds, so a retry of a failed job only re-requests the units that failed.
+        completed_evaluations = {int(i): evaluation for i, evaluation in job_state.get("candidate_results", {}).items()
+                                 if not is_failed_evaluation(evaluation)}
+        failed_criteria_batches = []
+        def record_criteria_batch(batch_key, batch_result):
+            if batch_result is None:
+                failed_criteria_batches.append(batch_key)
+            else:
+                job.record_checkpoint("criteria_batches", batch_key, batch_result)
+
+        def evaluations_succeeded(evaluations):
+            return not any(is_failed_evaluation(evaluation) for evaluation in evaluations)
+
+        # With tiered evaluation, the candidates re-evaluated by the second pass are tracked separately
+        # so the page can show that pass's progress next to the screening pass
+        escalated_candidates = None
+        escalation_lock = threading.Lock()
+        def start_escalation(indices):
+            nonlocal escalated_candidates
+            with escalation_lock:
+                escalated_candidates = []
+            job.update(escalating_candidates=indices, escalated_candidates=[])
+
+        def record_candidate_result(index, evaluation):
+            job.record_candidate_result(index, evaluation)
+            with escalation_lock:
+                if escalated_candidates is not None: # Every result after the escalation starts is a re-evaluation
+                    escalated_candidates.append(index)
+                    job.update(escalated_candidates=list(escalated_candidates))
+
+        def evaluate_all_candidates(jd_prompt_text):
+            evaluation_options = dict(use_cache=use_cache, on_result=record_candidate_result, completed=completed_evaluations)
+            if inputs.get("escalation_band"): # Tiered evaluation was selected for this report
+                return get_tiered_candidate_evaluation_data(jd_prompt_text, cv_texts, cv_filenames, escalation_band=inputs["escalation_band"],
+                                                            on_escalation=start_escalation, **evaluation_options)
+            return get_candidate_evaluation_data(jd_prompt_text, cv_texts, cv_filenames, **evaluation_options)
+
+        def jd_for_prompts(deps):
+            # The compiled requirement profile, or the raw JD if it couldn't be compiled. A failed
+            # compilation is still checkpointed (as None) so a retry doesn't mix the two within one report.
+            return format_jd_profile(deps["jd_profile"]) if deps["jd_profile"] else jd_text
+
+        def observations_stage(deps):
+            evaluations = deps["candidate_evaluations"]
+            if not evaluations_succeeded(evaluations):
+                if not allow_partial_results:
+                    return None # Summarizing an incomplete candidate pool would only be paid for twice
+                evaluations = [evaluation for evaluation in evaluations if not is_failed_evaluation(evaluation)]
+                if not evaluations:
+                    return {"GeneralObservations": FAILED_OBSERVATIONS_TEXT, "ShortlistedCandidates": []}
+            return run_stage(
+                "general_and_shortlist_data", "Step 3/3: Generating general observations and shortlist...",
+                lambda: get_general_observations_and_shortlist(evaluations, use_cache=use_cache),
+                succeeded=lambda result: result.get('GeneralObservations') != FAILED_OBSERVATIONS_TEXT
+            )
+
+        # Steps 1-3 run as a small task graph after the JD is compiled: the criteria comparison (Step 2)
+        # only needs the JD and CV texts, so it overlaps with the individual evaluations (Step 1),
+        # while the observations/shortlist (Step 3) starts as soon as Step 1 is done.
+        pipeline_results = run_task_graph({
+            "jd_profile": ([], lambda deps: run_stage(
+                "jd_profile", "Compiling the Job Description's requirement profile...",
+                lambda: compile_jd_profile(jd_text, use_cache=use_cache)
+            )),
+            "candidate_evaluations": (["jd_profile"], lambda deps: run_stage(
+                "candidate_evaluations", "Step 1/3: Evaluating individual candidates...",
+                lambda: evaluate_all_candidates(jd_for_prompts(deps)),
+                succeeded=evaluations_succeeded
+            )),
+            "criteria_comparison_data": (["jd_profile"], lambda deps: run_stage(
+                "criteria_comparison_data", "Step 2/3: Comparing candidates based on selected criteria...",
+                lambda: get_criteria_comparison_data(jd_for_prompts(deps), cv_texts, cv_filenames, inputs["selected_criteria"], use_cache=use_cache,
+                                                     completed_batches=checkpoints.get("criteria_batches"), on_batch_result=record_criteria_batch),
+                succeeded=lambda result: not failed_criteria_batches
+            )),
+            "general_and_shortlist_data": (["candidate_evaluations"], observations_stage)
+        })
+        candidate_evaluations = pipeline_results["candidate_evaluations"]
+        prescreen_results = inputs.get("prescreen_results", [])
+        if prescreen_results:
+            prescreen_score_by_filename = {r["Filename"]: r["PrescreenScore"] for r in prescreen_results}
+            for evaluation in candidate_evaluations:
+                evaluation["PrescreenScore"] = prescreen_score_by_filename.get(evaluation.get("OriginalFilename"))
+        criteria_comparison_data = pipeline_results["criteria_comparison_data"]
+        general_and_shortlist_data = pipeline_results["general_and_shortlist_data"]
+
+        # Anything that failed stops the job here, with everything that succeeded checkpointed for a
+        # retry - unless the user asked for the report with partial results
+        failures = []
+        failed_filenames = [evaluation.get("OriginalFilename") for evaluation in candidate_evaluations if is_failed_evaluation(evaluation)]
+        if failed_filenames:
+            failures.append(f"{len(failed_filenames)} of {len(candidate_evaluations)} candidate evaluations ({', '.join(failed_filenames)})")
+        if failed_criteria_batches:
+            failures.append(f"{len(failed_criteria_batches)} criteria comparison batch(es)")
+        if general_and_shortlist_data is None:
+            failures.append("general observations/shortlist (needs every candidate evaluation first)")
+        elif general_and_shortlist_data.get('GeneralObservations') == FAILED_OBSERVATIONS_TEXT:
+            failures.append("general observations/shortlist")
+        if failures and allow_partial_results:
+            job.add_message("warning", f"The report was generated with partial results. AI analysis failed for: {'; '.join(failures)}.")
+        elif failures:
+            job.update(status="failed", error=f"Some AI steps failed: {'; '.join(failures)}. Everything else "
+                                              "has been saved, so a retry only requests the failed parts.")
+            export_metrics("failed")
+            return
 
-    if criteria_comparison_data and candidate_evaluations:
-        # Get all unique candidate names from evaluations to ensure consistent column order
-        candidate_names_ordered = [cand['CandidateName'] for cand in candidate_evaluations]
-        
-        # Prepare headers: "Criteria" + all candidate names
-        criteria_headers = ["Criteria"] + candidate_names_ordered
-        
-        # Determine number of rows (number of criteria)
-        num_criteria = len(criteria_comparison_data)
-        
-        table = document.add_table(rows=num_criteria + 1, cols=len(criteria_headers))
-        table.style = 'Table Grid'
-
-        # Add header row for criteria comparison
-        hdr_cells = table.rows[0].cells
-        for i, header_text in enumerate(criteria_headers): # Use criteria_headers here
-            hdr_cells[i].text = header_text
-            hdr_cells[i].paragraphs[0].runs[0].font.bold = True
-            hdr_cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
-            hdr_cells[i].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-        
-        # Add data rows
-        row_idx = 1
-        for criteria, candidate_ratings in criteria_comparison_data.items():
-            row_cells = table.rows[row_idx].cells
-            row_cells[0].text = criteria # First cell is the criterion name
-            row_cells[0].paragraphs[0].runs[0].font.bold = True # Bold the criterion name
-
-            for col_idx, cand_name in enumerate(candidate_names_ordered):
-                # Use .get() with a default for robustness
-                emoji = candidate_ratings.get(cand_name, 'N/A')
-                row_cells[col_idx + 1].text = emoji # +1 because first col is 'Criteria'
-                row_cells[col_idx + 1].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER # Center emojis
-            row_idx += 1
-    else:
-        document.add_paragraph("No criteria comparison data available.")
+        # Prepare report data for DOCX generation and Firestore
+        report_data = {
+            "jd_filename": inputs["jd_filename"],
+            "cv_filenames": cv_filenames,
+            "generated_by_email": inputs["generated_by_email"],
+            "generated_by_username": inputs["generated_by_username"],
+            "timestamp": inputs["timestamp"], # ISO format for easy sorting in Firestore
+            "candidate_evaluations": candidate_evaluations,
+            "criteria_comparison_data": criteria_comparison_data,
+            "general_and_shortlist_data": general_and_shortlist_data,
+            "prescreen_results": prescreen_results,
+            "escalation_band": inputs.get("escalation_band"),
+            "failed_steps": failures # Empty unless the report was generated with partial results
+        }
+
+        # Generate the DOCX report
+        job.update(message="Creating the report document...")
+        with metrics.stage("render_docx"):
+            report_buffer = create_comparative_docx_report(
+                jd_text, cv_texts, report_data,
+                candidate_evaluations, criteria_comparison_data, general_and_shortlist_data
+            )
+        job.write_report(report_buffer.getvalue())
+
+        # Generate unique filename for the report
+        username = report_data.get('generated_by_username', 'UnknownUser')
+        timestamp = datetime.fromisoformat(report_data['timestamp']).strftime("%Y%m%d_%H%M%S")
+        report_full_filename = f"{username}_JD_CV_Analysis_Report_{timestamp}.docx" # MODIFIED LINE
+        job.update(report_filename=report_full_filename)
+
+        # Save report metadata to Firestore; the Drive upload below fills in drive_file_id later
+        report_data['drive_file_id'] = None
+        report_data['drive_upload_status'] = 'pending'
+        report_data['metrics'] = metrics.summary() # Everything up to saving the report
+        def save_to_firestore():
+            try:
+                report_id = save_report(report_data, report_id=job.job_id) # Keyed by the job, so a resumed save overwrites
+                job.add_message("success", "Report metadata saved to database.")
+                # Seed the rendered-report cache so the first download from 'All Reports' is instant
+                get_report_docx_cache().set(report_docx_cache_key(report_id, report_content_hash(report_data)), report_buffer.getvalue())
+                return report_id
+            except Exception as e:
+                job.add_message("error", f"Error saving report metadata to database: {e}")
+                return None
+        report_id = run_stage("report_id", "Saving the report...", save_to_firestore,
+                              succeeded=lambda report_id: report_id is not None)
+        if report_id is None:
+            # Failing here keeps the job (and its report document) around for a retry of the save
+            job.update(status="failed", error="The report was generated but could not be saved to the database. "
+                                              "Retry to save it again.")
+            export_metrics("failed")
+            return
 
-    document.add_page_break()
+        # Hand the upload to the background Drive uploader instead of waiting for it
+        def queue_drive_upload():
+            try:
+                get_drive_uploader().enqueue(report_id, report_full_filename, report_buffer.getvalue())
+                job.add_message("info", f"Report queued for upload to Google Drive: {report_full_filename}")
+                return True
+            except Exception as e:
+                job.add_message("error", f"Error queuing the Google Drive upload: {e}. You can still download the report directly.")
+                return False
+        run_stage("drive_upload_queued", "Queuing the Google Drive upload...", queue_drive_upload)
 
-    # --- General Observations and Shortlist ---
-    document.add_heading('General Observations', level=2)
-    document.add_paragraph(general_and_shortlist_data.get('GeneralObservations', 'No general observations available.'))
+        export_metrics("completed", report_id)
+        job.update(status="completed", progress=1.0, message="Report generated and saved!")
 
-    document.add_heading('📌 Final Shortlist Recommendation', level=2)
-    if general_and_shortlist_data.get('ShortlistedCandidates'):
-        document.add_paragraph(f"Shortlisted candidates: {', '.join(general_and_shortlist_data.get('ShortlistedCandidates'))}")
-    else:
-        document.add_paragraph("No candidates recommended for shortlist based on current analysis.")
+    try:
+        generate_report()
+    except Exception:
+        # ReportJobManager._run marks the job failed; this run's metrics, including the stage that
+        # raised, are saved with the job and exported first
+        export_metrics("failed")
+        raise
 
-    # Save the document to a BytesIO object
-    buffer = io.BytesIO()
-    document.save(buffer)
-    buffer.seek(0)
-    return buffer
 
 # --- Pages/UI Functions ---
 
@@ -797,6 +2408,9 @@ def show_login_and_create_account_forms():
         st.rerun()
 
 def setup_username_and_password_page():
+    from firebase_admin import auth
+    from firebase_admin import exceptions # Import exceptions module for FirebaseError
+    db = get_db() # Also initializes Firebase for the Auth calls
     st.image("sso_logo.png", width=100)
     st.markdown("<h2 style='text-align: center; color: #4CAF50;'>Complete Your Profile</h2>", unsafe_allow_html=True)
     st.write("Welcome! Please set a display name and your new password.")
@@ -851,6 +2465,7 @@ def generate_comparative_report_page():
 
     jd_file = st.file_uploader("Upload Job Description (PDF/DOCX)", type=["pdf", "docx"], key="jd_uploader")
     cv_files = st.file_uploader("Upload Candidate CVs (PDF/DOCX)", type=["pdf", "docx"], accept_multiple_files=True, key="cv_uploader")
+    cv_zip_file = st.file_uploader("Or upload a ZIP archive of Candidate CVs (PDF/DOCX) for large batches", type=["zip"], key="cv_zip_uploader")
 
     # Define the list of criteria for comparison
     comparison_criteria = [
@@ -865,124 +2480,258 @@ def generate_comparative_report_page():
             if st.checkbox(criterion, value=True, key=f"criterion_{criterion.replace(' ', '_')}"):
                 selected_criteria.append(criterion)
         
+        st.write("Optionally pre-screen large candidate pools locally so that only the closest matches are sent to the AI.")
+        enable_prescreen = st.checkbox("Enable local pre-screening", value=False, key="enable_prescreen")
+        prescreen_top_k = st.number_input("Maximum candidates sent to AI (top-K)", min_value=1, value=25, step=1, key="prescreen_top_k", disabled=not enable_prescreen)
+        prescreen_min_score = st.slider("Minimum pre-screen score (%)", min_value=0, max_value=100, value=0, key="prescreen_min_score", disabled=not enable_prescreen)
+
+        st.write(f"Optionally score every candidate with the faster {OPENAI_SCREENING_MODEL} model first and re-evaluate only the candidates within a Match % band with {OPENAI_MODEL}.")
+        enable_tiered_evaluation = st.checkbox("Enable tiered evaluation", value=False, key="enable_tiered_evaluation")
+        escalation_band = st.slider(f"Match % band re-evaluated with {OPENAI_MODEL}", min_value=0, max_value=100,
+                                    value=ESCALATION_MATCH_BAND, key="escalation_band", disabled=not enable_tiered_evaluation)
+
+        bypass_ai_cache = st.checkbox("Bypass AI response cache (always request fresh analysis)", value=False, key="bypass_ai_cache")
+
+        if st.session_state['is_admin']:
+            text_cache_stats = get_text_extraction_cache().stats()
+            st.caption(f"Text extraction cache: {text_cache_stats['memory_hits']} memory hits, {text_cache_stats['disk_hits']} disk hits, "
+                       f"{text_cache_stats['misses']} misses ({text_cache_stats['hit_rate']:.0%} hit rate), "
+                       f"{text_cache_stats['disk_bytes'] / (1024 * 1024):.1f} MB on disk")
+            llm_cache_stats = get_llm_response_cache().stats()
+            st.caption(f"AI response cache: {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses "
+                       f"({llm_cache_stats['hit_rate']:.0%} hit rate), {llm_cache_stats['bytes'] / (1024 * 1024):.1f} MB on disk")
+            for model in dict.fromkeys([OPENAI_MODEL, OPENAI_SCREENING_MODEL]):
+                scheduler_stats = get_openai_scheduler(model).stats()
+                st.caption(f"OpenAI scheduler ({model}): {scheduler_stats['requests']} requests, {scheduler_stats['retries']} retries "
+                           f"({scheduler_stats['rate_limited']} rate limited), {scheduler_stats['throttled_seconds']:.0f}s spent waiting for rate-limit budget")
+            report_docx_cache_stats = get_report_docx_cache().stats()
+            st.caption(f"Rendered report cache: {report_docx_cache_stats['hits']} hits, {report_docx_cache_stats['misses']} misses "
+                       f"({report_docx_cache_stats['hit_rate']:.0%} hit rate), {report_docx_cache_stats['bytes'] / (1024 * 1024):.1f} MB on disk")
+
         if not selected_criteria:
             st.warning("Please select at least one criterion for comparison.")
             return # Prevent generation if no criteria are selected
 
     if st.button("Generate Report", key="generate_report_button"):
-        if jd_file and cv_files:
-            with st.spinner("Analyzing documents and generating report... This may take a few moments."):
-                jd_text = ""
-                if jd_file.type == "application/pdf":
-                    jd_text = get_pdf_text(jd_file)
-                elif jd_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                    jd_text = get_docx_text(jd_file)
-                else:
-                    st.error("Unsupported JD file type.")
+        if jd_file and (cv_files or cv_zip_file):
+            with st.spinner("Reading uploaded documents..."):
+                extraction_started_at = time.perf_counter()
+                # The JD, the individually uploaded CVs and the members of the ZIP archive (streamed one
+                # at a time, skipping duplicates of the uploaded CVs) go through a single extraction pass,
+                # with the JD first
+                cv_documents = [(f.name, get_file_kind(f), f.getvalue()) for f in cv_files or []]
+                skipped_zip_members = []
+                if cv_zip_file:
+                    seen_hashes = {hashlib.sha256(file_bytes).hexdigest() for _, _, file_bytes in cv_documents}
+                    cv_documents = itertools.chain(cv_documents, iter_zip_documents(cv_zip_file, seen_hashes, skipped_zip_members))
+                jd_document = (jd_file.name, get_file_kind(jd_file), jd_file.getvalue())
+                try:
+                    [(_, jd_text, jd_error), *cv_results] = extract_documents_text(itertools.chain([jd_document], cv_documents))
+                except zipfile.BadZipFile:
+                    st.error(f"{cv_zip_file.name} is not a valid ZIP archive.")
                     return
+                if jd_text is None:
+                    st.error(f"Could not read the Job Description ({jd_file.name}): {jd_error}")
+                    return
+                for member_name, reason in skipped_zip_members:
+                    st.warning(f"Skipping {member_name} from {cv_zip_file.name}: {reason}")
 
                 cv_texts = []
                 cv_filenames = []
-                for cv_file in cv_files:
-                    cv_filenames.append(cv_file.name)
-                    if cv_file.type == "application/pdf":
-                        cv_texts.append(get_pdf_text(cv_file))
-                    elif cv_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                        cv_texts.append(get_docx_text(cv_file))
-                    else:
-                        st.warning(f"Skipping unsupported CV file type: {cv_file.name}")
+                for cv_filename, cv_text, cv_error in cv_results:
+                    if cv_text is None:
+                        st.warning(f"Skipping CV {cv_filename}: {cv_error}")
                         continue
+                    cv_filenames.append(cv_filename)
+                    cv_texts.append(cv_text)
                 
                 if not cv_texts:
                     st.error("No supported CV files found to analyze.")
                     return
 
-                # Step 1: Get individual candidate evaluations
-                st.info("Step 1/3: Evaluating individual candidates...")
-                candidate_evaluations = get_candidate_evaluation_data(jd_text, cv_texts, cv_filenames)
-                if any("Error: Could not get response from AI." in str(c.values()) for c in candidate_evaluations):
-                    st.error("Failed to get complete candidate evaluations from AI. Report generation aborted.")
-                    return
+                page_timings = {"extraction": time.perf_counter() - extraction_started_at}
+
+                # Optional local pre-screen: score every CV against the JD and keep only the best matches
+                prescreen_results = []
+                if enable_prescreen:
+                    prescreen_started_at = time.perf_counter()
+                    prescreen_scores = prescreen_candidates(jd_text, cv_texts)
+                    selected_indices = set(select_prescreened_candidates(prescreen_scores, int(prescreen_top_k), prescreen_min_score / 100))
+                    prescreen_results = [
+                        {"Filename": filename, "PrescreenScore": round(float(score) * 100, 1), "SentToAI": i in selected_indices}
+                        for i, (filename, score) in enumerate(zip(cv_filenames, prescreen_scores))
+                    ]
+                    page_timings["prescreen"] = time.perf_counter() - prescreen_started_at
+                    st.info(f"Pre-screening: {len(selected_indices)} of {len(cv_texts)} candidates sent to AI for detailed evaluation.")
+                    if not selected_indices:
+                        st.error("No candidates passed the pre-screening threshold. Lower the minimum score and try again.")
+                        return
+                    cv_texts = [cv_texts[i] for i in sorted(selected_indices)]
+                    cv_filenames = [cv_filenames[i] for i in sorted(selected_indices)]
+
+            # Hand the AI pipeline over to a background job; the page only polls its progress
+            job_id = get_report_job_manager().submit({
+                "jd_text": jd_text,
+                "jd_filename": jd_file.name,
+                "cv_texts": cv_texts,
+                "cv_filenames": cv_filenames,
+                "selected_criteria": selected_criteria,
+                "use_cache": not bypass_ai_cache,
+                "escalation_band": list(escalation_band) if enable_tiered_evaluation else None,
+                "prescreen_results": prescreen_results,
+                "page_timings": page_timings,
+                "generated_by_email": st.session_state['user_email'],
+                "generated_by_username": st.session_state['username'],
+                "timestamp": datetime.now().isoformat()
+            }, owner_email=st.session_state['user_email'])
+            st.session_state['report_job_id'] = job_id
+            st.query_params['report_job'] = job_id # Lets the page reattach after a browser refresh
+        else:
+            st.error("Please upload both a Job Description and at least one CV (or a ZIP archive of CVs) to generate a report.")
+
+    report_job_id = st.session_state.get('report_job_id') or st.query_params.get('report_job')
+    if report_job_id:
+        show_report_job(report_job_id)
+
+@st.fragment(run_every=REPORT_JOB_POLL_SECONDS)
+def report_job_progress(job_id):
+    # Only this fragment re-runs while the job is working, so the rest of the page stays responsive
+    job_state = get_report_job_manager().get(job_id).snapshot()
+    if job_state.get('status') not in ACTIVE_JOB_STATUSES:
+        st.rerun() # Job finished: re-run the whole page to show the result
+    st.progress(job_state.get('progress', 0.0), text=job_state.get('message', 'Working...'))
+    show_live_candidate_results(job_state)
+
+def show_live_candidate_results(job_state):
+    # Live view of Step 1: candidates appear as soon as their evaluation arrives, with a
+    # provisional ranking that re-sorts as new scores come in.
+    candidate_filenames = job_state.get('candidate_filenames', [])
+    candidate_results = job_state.get('candidate_results', {})
+    if not candidate_filenames:
+        return
+    if job_state.get('tiered_evaluation'):
+        # The screening pass and the re-evaluation of borderline/failed candidates get a bar each
+        st.progress(len(candidate_results) / len(candidate_filenames),
+                    text=f"Candidates screened ({OPENAI_SCREENING_MODEL}): {len(candidate_results)} of {len(candidate_filenames)}")
+        escalating_candidates = job_state.get('escalating_candidates')
+        escalated_candidates = set(job_state.get('escalated_candidates', []))
+        if escalating_candidates is None:
+            st.progress(0.0, text=f"Re-evaluation ({OPENAI_MODEL}): waiting for screening to finish")
+        elif escalating_candidates:
+            st.progress(len(escalated_candidates) / len(escalating_candidates),
+                        text=f"Candidates re-evaluated ({OPENAI_MODEL}): {len(escalated_candidates)} of {len(escalating_candidates)}")
+        else:
+            st.progress(1.0, text=f"Re-evaluation ({OPENAI_MODEL}): no candidates needed it")
+        awaiting_re_evaluation = {str(i) for i in escalating_candidates or []} - {str(i) for i in escalated_candidates}
+    else:
+        st.progress(len(candidate_results) / len(candidate_filenames),
+                    text=f"Candidates evaluated: {len(candidate_results)} of {len(candidate_filenames)}")
+        awaiting_re_evaluation = set()
+
+    finished = sorted(candidate_results.items(), key=lambda item: item[1].get('MatchPercent', 0), reverse=True)
+    rows = []
+    for rank, (index, evaluation) in enumerate(finished):
+        if index in awaiting_re_evaluation:
+            status = "🔁 Re-evaluating"
+        else:
+            status = "⚠️ Failed" if is_failed_evaluation(evaluation) else "✅ Done"
+        rows.append({
+            "Status": status,
+            "Provisional Rank": rank + 1,
+            "Candidate": evaluation.get('CandidateName', 'N/A'),
+            "Match %": evaluation.get('MatchPercent', 0),
+            "Model": evaluation.get('EvaluationModel', ''),
+            "CV File": evaluation.get('OriginalFilename', 'N/A')
+        })
+    for i, filename in enumerate(candidate_filenames):
+        if str(i) not in candidate_results:
+            rows.append({"Status": "⏳ Pending", "Provisional Rank": None, "Candidate": "", "Match %": None, "Model": "", "CV File": filename})
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+
+def show_report_metrics(metrics_summary, key):
+    # Admin-only breakdown of where a report's time, tokens and (estimated) money went
+    stages = metrics_summary.get('stages', {})
+    if not stages:
+        return
+    with st.expander("Report Metrics (Admin)"):
+        rows = []
+        for stage_name, stage in list(stages.items()) + [("Total", metrics_summary.get('totals', {}))]:
+            rows.append({
+                "Stage": stage_name,
+                "Wall Time (s)": round(stage.get('seconds', 0), 2),
+                "LLM Calls": stage.get('llm_calls', 0),
+                "Cache Hits": stage.get('cache_hits', 0),
+                "Errors": stage.get('errors', 0),
+                "Retries": stage.get('retries', 0),
+                "Prompt Tokens": stage.get('prompt_tokens', 0),
+                "Cached Prompt Tokens": stage.get('cached_prompt_tokens', 0),
+                "Completion Tokens": stage.get('completion_tokens', 0),
+                "Est. Cost (USD)": round(stage.get('cost_usd', 0), 4)
+            })
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        st.caption("Stages that run concurrently (the AI steps) overlap, so their wall times add up to more than the elapsed time.")
+        unpriced_models = [model for model in dict.fromkeys([OPENAI_MODEL, OPENAI_SCREENING_MODEL]) if get_openai_pricing(model) is None]
+        if unpriced_models:
+            st.caption(f"Cost unknown for {', '.join(unpriced_models)} (no entry in OPENAI_PRICING_PER_MILLION_TOKENS); "
+                       "calls to it are counted as $0.")
+        st.download_button("Export Metrics (JSON)", data=json.dumps(metrics_summary, indent=2), file_name=f"report_metrics_{key}.json",
+                           mime="application/json", key=f"export_metrics_{key}")
+
+def show_report_job(job_id):
+    job = get_report_job_manager().get(job_id)
+    if job is None or job.state.get('owner_email') != st.session_state['user_email']:
+        return
+    job_state = job.snapshot()
 
-                # Step 2: Get criteria comparison data
-                st.info("Step 2/3: Comparing candidates based on selected criteria...")
-                criteria_comparison_data = get_criteria_comparison_data(jd_text, cv_texts, cv_filenames, selected_criteria)
-                if any("error" in str(criteria_comparison_data.values()) for c in criteria_comparison_data.values()): # Check for errors in inner dicts
-                    st.error("Failed to get criteria comparison from AI. Report generation aborted.")
-                    return
+    st.markdown("---")
+    if job_state.get('status') in ACTIVE_JOB_STATUSES:
+        st.info("Your report is being generated in the background. You can leave this page open or come back to it later.")
+        report_job_progress(job_id)
+        return
 
-                # Step 3: Get general observations and shortlist
-                st.info("Step 3/3: Generating general observations and shortlist...")
-                general_and_shortlist_data = get_general_observations_and_shortlist(candidate_evaluations)
-                if "error" in general_and_shortlist_data.get('GeneralObservations', '').lower():
-                    st.error("Failed to get general observations/shortlist from AI. Report generation aborted.")
-                    return
+    for level, text in job_state.get('messages', []):
+        getattr(st, level)(text)
 
-                # Prepare report data for DOCX generation and Firestore
-                report_data = {
-                    "jd_filename": jd_file.name,
-                    "cv_filenames": cv_filenames,
-                    "generated_by_email": st.session_state['user_email'],
-                    "generated_by_username": st.session_state['username'],
-                    "timestamp": datetime.now().isoformat(), # ISO format for easy sorting in Firestore
-                    "candidate_evaluations": candidate_evaluations,
-                    "criteria_comparison_data": criteria_comparison_data,
-                    "general_and_shortlist_data": general_and_shortlist_data
-                }
-
-                # Generate the DOCX report
-                report_buffer = create_comparative_docx_report(
-                    jd_text, cv_texts, report_data,
-                    candidate_evaluations, criteria_comparison_data, general_and_shortlist_data
-                )
-
-                # Generate unique filename for the report
-                username = report_data.get('generated_by_username', 'UnknownUser')
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                report_full_filename = f"{username}_JD_CV_Analysis_Report_{timestamp}.docx" # MODIFIED LINE
-
-                # Upload to Google Drive
-                try:
-                    if drive_service and GOOGLE_DRIVE_REPORTS_FOLDER_ID:
-                        file_metadata = {
-                            'name': report_full_filename,
-                            'parents': [GOOGLE_DRIVE_REPORTS_FOLDER_ID],
-                            'mimeType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-                        }
-                        media = MediaIoBaseUpload(report_buffer, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', resumable=True)
-                        uploaded_file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-                        report_data['drive_file_id'] = uploaded_file.get('id')
-                        st.success(f"Report uploaded to Google Drive: {report_full_filename}")
-                except Exception as e:
-                    st.error(f"Error uploading to Google Drive: {e}. You can still download the report directly.")
-                    report_data['drive_file_id'] = None # Ensure it's marked as failed upload
+    if st.session_state['is_admin'] and job_state.get('metrics'):
+        metrics_summary = ReportMetrics(job_state['metrics']).summary()
+        show_report_metrics(metrics_summary, job_id)
 
-                # Save report metadata to Firestore
-                try:
-                    reports_collection = db.collection('reports')
-                    reports_collection.add(report_data)
-                    st.success("Report metadata saved to database.")
-                except Exception as e:
-                    st.error(f"Error saving report metadata to database: {e}")
-
-                st.success("Report generated and saved!")
-
-                # Provide download link
-                st.download_button(
-                    label="Download Report",
-                    data=report_buffer.getvalue(), # Use getvalue() after seeking to 0
-                    file_name=report_full_filename,
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    key="download_button"
-                )
-        else:
-            st.error("Please upload both a Job Description and at least one CV to generate a report.")
+    if job_state.get('status') == 'failed':
+        st.error(job_state.get('error', 'Report generation failed.'))
+        retry_col, partial_col = st.columns(2)
+        if retry_col.button("Retry Failed Steps", key=f"retry_report_job_{job_id}"):
+            get_report_job_manager().retry(job_id)
+            st.rerun()
+        if partial_col.button("Generate with Partial Results", key=f"partial_report_job_{job_id}",
+                              help="Tries the failed steps once more, then generates the report with anything still failing marked as failed."):
+            get_report_job_manager().retry(job_id, allow_partial_results=True)
+            st.rerun()
+        return
+
+    st.success("Report generated and saved!")
+
+    # Provide download link
+    report_bytes = job.read_report()
+    if report_bytes:
+        st.download_button(
+            label="Download Report",
+            data=report_bytes,
+            file_name=job_state.get('report_filename', 'JD_CV_Analysis_Report.docx'),
+            mime=DOCX_MIME_TYPE,
+            key="download_button"
+        )
+
+REPORTS_PAGE_SIZE = 25
+# Fields fetched for the report listing; the (large) analysis payloads are left out
+REPORT_LISTING_FIELDS = ['jd_filename', 'cv_filenames', 'generated_by_email', 'generated_by_username', 'timestamp', 'drive_file_id', 'drive_upload_status', 'content_hash']
 
 def show_all_reports_page():
     st.markdown("<h1 style='text-align: center; color: #4CAF50;'>SSO Consultants AI Recruitment Tool</h1>", unsafe_allow_html=True)
     st.subheader("All Generated Reports")
     st.write(f"Logged in as: **{st.session_state.get('username', st.session_state.get('user_email', 'Guest'))}** {'(Admin)' if st.session_state['is_admin'] else ''}")
 
+    from firebase_admin import firestore
+    db = get_db()
     reports_ref = db.collection('reports')
     if not st.session_state['is_admin']:
         # Filter reports by the current user's email if not admin
@@ -991,9 +2740,22 @@ def show_all_reports_page():
         # Admins can see all reports
         reports_query = reports_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
 
+    # Cursor-based pagination: each page fetches only REPORTS_PAGE_SIZE documents and only the fields
+    # the table needs. report_page_cursors[i] is the last document of page i-1 (None for the first page).
+    if 'report_page_cursors' not in st.session_state:
+        st.session_state['report_page_cursors'] = [None]
+    page_cursors = st.session_state['report_page_cursors']
+    # Admins also get each report's metrics summary (see show_report_metrics)
+    page_query = reports_query.select(REPORT_LISTING_FIELDS + (['metrics'] if st.session_state['is_admin'] else []))
+    if page_cursors[-1] is not None:
+        page_query = page_query.start_after(page_cursors[-1])
+
     try:
-        reports_docs = reports_query.stream()
+        reports_docs = list(page_query.limit(REPORTS_PAGE_SIZE + 1).stream()) # One extra to know if there's a next page
+        has_next_page = len(reports_docs) > REPORTS_PAGE_SIZE
+        reports_docs = reports_docs[:REPORTS_PAGE_SIZE]
         reports = []
+        metrics_by_id = {} # Kept out of the table rows, which only hold flat values
         for doc in reports_docs:
             report_data = doc.to_dict()
             reports.append({
@@ -1004,8 +2766,11 @@ def show_all_reports_page():
                 'generated_by_username': report_data.get('generated_by_username', 'N/A'),
                 'timestamp': datetime.fromisoformat(report_data['timestamp']).strftime('%Y-%m-%d %H:%M:%S') if 'timestamp' in report_data else 'N/A',
                 'drive_file_id': report_data.get('drive_file_id'),
-                'raw_data': report_data # Keep raw data for re-creating report if needed
+                'drive_upload_status': report_data.get('drive_upload_status'),
+                'content_hash': report_data.get('content_hash')
             })
+            metrics_by_id[doc.id] = report_data.get('metrics')
+        reports_by_id = {r['id']: r for r in reports}
 
         if not reports:
             st.info("No reports found. Generate one in the 'Generate Report' section.")
@@ -1022,58 +2787,69 @@ def show_all_reports_page():
                 "cv_filenames": "CVs Analyzed",
                 "id": None, # Hide internal ID
                 "drive_file_id": None, # Hide drive ID in table
-                "raw_data": None # Hide raw data in table
+                "drive_upload_status": None,
+                "content_hash": None
             },
             use_container_width=True
         )
 
+        col_prev, col_page, col_next = st.columns(3)
+        with col_prev:
+            if st.button("Previous Page", key="reports_prev_page", disabled=len(page_cursors) == 1):
+                page_cursors.pop()
+                st.rerun()
+        with col_page:
+            st.markdown(f"<p style='text-align: center;'>Page {len(page_cursors)}</p>", unsafe_allow_html=True)
+        with col_next:
+            if st.button("Next Page", key="reports_next_page", disabled=not has_next_page):
+                page_cursors.append(reports_docs[-1])
+                st.rerun()
+
         st.markdown("---")
         st.subheader("Actions on Reports")
         
         # Allow users to select a report from the displayed list
         selected_report_id = st.selectbox(
             "Select a report to view/download:",
-            options=[r['id'] for r in reports], 
-            format_func=lambda x: f"Report {next((r['timestamp'] for r in reports if r['id'] == x), 'N/A')} - {next((r['jd_filename'] for r in reports if r['id'] == x), 'N/A')}", 
+            options=list(reports_by_id), 
+            format_func=lambda x: f"Report {reports_by_id[x]['timestamp']} - {reports_by_id[x]['jd_filename']}", 
             key="report_selector"
         )
         
-        selected_report = next((r for r in reports if r['id'] == selected_report_id), None)
+        selected_report = reports_by_id.get(selected_report_id)
 
         if selected_report:
             if selected_report['drive_file_id']:
                 # Generate a shareable link from Google Drive file ID
                 drive_link = f"https://drive.google.com/file/d/{selected_report['drive_file_id']}/view?usp=sharing"
                 st.markdown(f"**View/Download on Google Drive:** [Click Here]({drive_link})")
+            elif selected_report['drive_upload_status'] == 'pending':
+                st.info("The Google Drive upload for this report is still in progress (failed attempts are retried automatically). Check back shortly.")
             else:
                 st.warning("Report not available on Google Drive. It might have failed to upload or was generated before this feature was enabled.")
             
             # Option to re-generate and download if drive file is missing or for local access
             if st.button("Download as DOCX (Re-generate if needed)", key=f"download_report_{selected_report_id}"):
-                with st.spinner("Re-generating report for download..."):
-                    jd_text_for_regen = "" # You might need to fetch this from a stored JD or re-upload
-                    cv_texts_for_regen = [] # Same here
-                    
-                    # For simplicity, we'll use a placeholder for actual content and rely on saved report_data
-                    # In a real app, you'd retrieve JD/CV content from storage or re-process.
-                    # For now, we'll just reconstruct the DOCX based on the saved report_data
-                    report_buffer_regen = create_comparative_docx_report(
-                        "Job Description text placeholder", # This text is not used in create_comparative_docx_report currently, only for function signature
-                        ["CV text placeholder"], # This text is not used
-                        selected_report['raw_data'], # Use the raw_data dictionary for docx generation
-                        selected_report['raw_data'].get('candidate_evaluations', []),
-                        selected_report['raw_data'].get('criteria_comparison_data', {}),
-                        selected_report['raw_data'].get('general_and_shortlist_data', {})
+                with st.spinner("Preparing report for download..."):
+                    # Served from the local cache or the Drive copy when possible; re-rendered only as a last resort
+                    report_docx_bytes, report_source = get_report_docx_bytes(
+                        selected_report_id, selected_report['content_hash'], selected_report['drive_file_id']
                     )
                     st.download_button(
                         label="Download Re-generated Report",
-                        data=report_buffer_regen.getvalue(),
+                        data=report_docx_bytes,
                         file_name=f"{selected_report['generated_by_username']}_{selected_report['jd_filename'].replace('.pdf', '').replace('.docx', '')}_Analysis_{selected_report['timestamp'].replace(' ', '_').replace(':', '-')}.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                         key=f"download_regen_button_{selected_report_id}"
                     )
-                    st.success("Report re-generated and ready for download.")
+                    if report_source == "rendered":
+                        st.success("Report re-generated and ready for download.")
+                    else:
+                        st.success("Report ready for download.")
             
+            if st.session_state['is_admin'] and metrics_by_id.get(selected_report_id):
+                show_report_metrics(metrics_by_id[selected_report_id], selected_report_id)
+
             if st.session_state['is_admin']:
                 if st.button("Delete Report (Admin Only)", key=f"delete_report_{selected_report_id}"):
                     # Added a confirmation step for deletion
@@ -1081,11 +2857,11 @@ def show_all_reports_page():
                         if st.button("Confirm Deletion", key=f"confirm_delete_{selected_report_id}"): # Changed key for clarity
                             try:
                                 # Delete from Firestore
-                                db.collection('reports').document(selected_report_id).delete()
+                                delete_report(selected_report_id)
                                 # Optionally: Delete from Google Drive too if drive_file_id exists
                                 if selected_report['drive_file_id']:
                                     try:
-                                        drive_service.files().delete(fileId=selected_report['drive_file_id']).execute()
+                                        get_drive_service().files().delete(fileId=selected_report['drive_file_id']).execute()
                                         st.success("Report deleted from Google Drive.")
                                     except Exception as e:
                                         st.warning(f"Could not delete file from Google Drive: {e}. It might have been moved or already deleted.")
@@ -1097,6 +2873,34 @@ def show_all_reports_page():
     except Exception as e:
         st.error(f"Error fetching reports: {e}")
 
+AUTH_LOOKUP_BATCH_SIZE = 100 # Maximum identifiers per Firebase Auth get_users() call
+USER_LIST_CACHE_SECONDS = 30
+
+@st.cache_data(ttl=USER_LIST_CACHE_SECONDS, show_spinner=False)
+def load_users():
+    # Firestore user documents joined in memory with their Firebase Auth status. Auth is queried
+    # in batches of AUTH_LOOKUP_BATCH_SIZE rather than once per user; the result is cached briefly
+    # and cleared by the admin actions that change it.
+    from firebase_admin import auth
+    user_docs = [(doc.id, doc.to_dict()) for doc in load_firestore_client().collection('users').stream()]
+    disabled_by_uid = {}
+    for start in range(0, len(user_docs), AUTH_LOOKUP_BATCH_SIZE):
+        batch = user_docs[start:start + AUTH_LOOKUP_BATCH_SIZE]
+        lookup_result = auth.get_users([auth.UidIdentifier(uid) for uid, _ in batch])
+        for firebase_user in lookup_result.users:
+            disabled_by_uid[firebase_user.uid] = firebase_user.disabled
+
+    users = []
+    for uid, user_data in user_docs:
+        users.append({
+            'uid': uid,
+            'email': user_data.get('email', 'N/A'),
+            'username': user_data.get('username', 'Not Set'),
+            'is_admin': user_data.get('is_admin', False),
+            'disabled': disabled_by_uid.get(uid, True) # Assume disabled if user not found in Auth (e.g., deleted manually)
+        })
+    return users
+
 def manage_users_page():
     if not st.session_state['is_admin']:
         st.error("Access Denied: You must be an admin to manage users.")
@@ -1129,30 +2933,17 @@ def manage_users_page():
                 st.error("Please confirm granting admin privileges.")
             else:
                 create_user(new_member_email, temp_password, is_admin_invite)
+                load_users.clear() # Invalidate the cached user list
                 st.rerun() # Refresh page to show updated user list and clear form
 
     st.markdown("---")
     st.write("Here you can view, activate/deactivate, and delete existing user accounts.")
 
-    users_ref = db.collection('users')
+    from firebase_admin import auth
+    from firebase_admin import exceptions # Import exceptions module for FirebaseError
+    db = get_db() # Also initializes Firebase for the Auth calls
     try:
-        users_docs = users_ref.stream()
-        users = []
-        for doc in users_docs:
-            user_data = doc.to_dict()
-            try:
-                firebase_user = auth.get_user(doc.id) # Fetch current status from Firebase Auth
-                disabled_status = firebase_user.disabled
-            except Exception:
-                disabled_status = True # Assume disabled if user not found in Auth (e.g., deleted manually)
-
-            users.append({
-                'uid': doc.id,
-                'email': user_data.get('email', 'N/A'),
-                'username': user_data.get('username', 'Not Set'),
-                'is_admin': user_data.get('is_admin', False),
-                'disabled': disabled_status
-            })
+        users = load_users()
         
         # Filter out the current logged-in admin from the list of selectable users
         display_users = [u for u in users if u['uid'] != st.session_state['user_uid']]
@@ -1187,6 +2978,7 @@ def manage_users_page():
                         new_admin_status = not selected_user['is_admin']
                         db.collection('users').document(selected_user['uid']).update({'is_admin': new_admin_status})
                         st.success(f"Admin status for {selected_user_email} changed to {new_admin_status}.")
+                        load_users.clear() # Invalidate the cached user list
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error toggling admin status: {e}")
@@ -1196,6 +2988,7 @@ def manage_users_page():
                         new_disabled_status = not selected_user['disabled']
                         auth.update_user(selected_user['uid'], disabled=new_disabled_status)
                         st.success(f"Account status for {selected_user_email} changed to {'disabled' if new_disabled_status else 'enabled'}.")
+                        load_users.clear() # Invalidate the cached user list
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error toggling account status: {e}")
@@ -1210,6 +3003,7 @@ def manage_users_page():
                                 # Delete from Firestore
                                 db.collection('users').document(selected_user['uid']).delete()
                                 st.success(f"User {selected_user_email} deleted successfully.")
+                                load_users.clear() # Invalidate the cached user list
                                 st.rerun()
                             except exceptions.FirebaseError as e:
                                 st.error(f"Error deleting user: {e.code}")
@@ -1225,12 +3019,7 @@ def manage_users_page():
 
 # --- Main Application Logic ---
 # --- Fixed Position Logo ---
-st.markdown(
-    """
-    <img src="data:image/png;base64,{}" class="fixed-top-left-logo">
-    """.format(base64.b64encode(open("logo.png", "rb").read()).decode()),
-    unsafe_allow_html=True
-)
+st.markdown(load_static_assets()["logo_html"], unsafe_allow_html=True)
 
 
 if not st.session_state['logged_in']:
@@ -1241,6 +3030,8 @@ if not st.session_state['logged_in']:
 elif st.session_state['needs_username_setup']:
     setup_username_and_password_page()
 else:
+    get_drive_uploader() # Starts the uploader thread (resuming any uploads queued before a restart)
+
     # Sidebar for navigation
     with st.sidebar:
         st.image("sso_logo.png", use_container_width=True)
@@ -1303,3 +3094,12 @@ st.markdown(
     """,
     unsafe_allow_html=True
 )
+
+
+# --- Startup Budget ---
+# Logs any script run (including the first render after a cold start) that exceeds the budget;
+# benchmarks/bench_startup.py measures import time and time-to-first-render against it.
+STARTUP_BUDGET_SECONDS = 1.5
+script_run_seconds = time.perf_counter() - SCRIPT_START_TIME
+if script_run_seconds > STARTUP_BUDGET_SECONDS:
+    print(f"WARNING: Script run took {script_run_seconds:.2f}s, over the {STARTUP_BUDGET_SECONDS}s startup budget.")
@@ -0,0 +1,175 @@
+# DOCX report rendering benchmark.
+#
+# Renders create_comparative_docx_report for synthetic reports of 10, 100 and 1,000 candidates
+# (6 criteria) with (a) the bulk table writer in docx_report.py and (b) the previous cell-by-cell
+# python-docx path, reporting render time and peak memory for each. Every measurement runs in a
+# fresh interpreter (the parent never renders: on Linux a child starts with its parent's peak RSS);
+# tracemalloc peak is reported alongside it (it only sees Python allocations, not lxml's). Both
+# paths are also rendered once at each size and their word/document.xml compared, so the speed-up
+# can't come from producing a different document.
+#
+# Usage (from the repository root): python benchmarks/bench_docx_tables.py [--sizes 10 100 1000] [--runs N]
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zipfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import docx_report
+
+CRITERIA = ["Technical Skills", "Experience", "Education", "Location", "Communication", "Leadership"]
+RATINGS = ["✅", "❌", "⚠️"]
+DATE_LINE_PATTERN = re.compile(r"Date: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+
+
+def add_table_cell_by_cell(document, headers, rows, bold_columns=(), centered_columns=(), style='Table Grid'):
+    # The rendering path the report used before the bulk writer: one python-docx call per cell
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.enum.table import WD_ALIGN_VERTICAL
+
+    table = document.add_table(rows=1, cols=len(headers))
+    table.style = style
+    hdr_cells = table.rows[0].cells
+    for i, header_text in enumerate(headers):
+        hdr_cells[i].text = header_text
+        hdr_cells[i].paragraphs[0].runs[0].font.bold = True
+        hdr_cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+        hdr_cells[i].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+    for row in rows:
+        row_cells = table.add_row().cells
+        for i, value in enumerate(row):
+            row_cells[i].text = value
+            if i in bold_columns:
+                row_cells[i].paragraphs[0].runs[0].font.bold = True
+            if i in centered_columns:
+                row_cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+    return table
+
+
+def synthetic_report(num_candidates):
+    candidate_evaluations = [
+        {
+            "CandidateName": f"Candidate {i:04d}",
+            "MatchPercent": 95 - i % 60,
+            "Ranking": i + 1,
+            "ShortlistProbability": ["High", "Medium", "Low"][i % 3],
+            "KeyStrengths": "Python, distributed systems, mentoring.\nLed a team of 6 engineers.",
+            "KeyGaps": "No Kubernetes experience;\tlimited exposure to finance",
+            "LocationSuitability": "Relocation required" if i % 4 else "Local",
+            "Comments": f"Strong backend profile & good <communication> skills ({i}). ",
+            "OriginalFilename": f"cv_{i:04d}.pdf",
+        }
+        for i in range(num_candidates)
+    ]
+    criteria_comparison_data = {
+        criterion: {c["CandidateName"]: RATINGS[(i + j) % 3] for i, c in enumerate(candidate_evaluations)}
+        for j, criterion in enumerate(CRITERIA)
+    }
+    report_data = {
+        "generated_by_username": "benchmark",
+        "jd_filename": "jd.pdf",
+        "cv_filenames": [c["OriginalFilename"] for c in candidate_evaluations],
+        "prescreen_results": [
+            {"Filename": c["OriginalFilename"], "PrescreenScore": round(100 - i * 0.05, 1), "SentToAI": True}
+            for i, c in enumerate(candidate_evaluations)
+        ],
+    }
+    general_and_shortlist_data = {
+        "GeneralObservations": "Most candidates have strong backend experience.",
+        "ShortlistedCandidates": [c["CandidateName"] for c in candidate_evaluations[:5]],
+    }
+    return report_data, candidate_evaluations, criteria_comparison_data, general_and_shortlist_data
+
+
+def render(writer, num_candidates):
+    report_data, candidate_evaluations, criteria_comparison_data, general_and_shortlist_data = synthetic_report(num_candidates)
+    original_writer = docx_report.add_bulk_table
+    if writer == "cell_by_cell":
+        docx_report.add_bulk_table = add_table_cell_by_cell
+    try:
+        return docx_report.create_comparative_docx_report(
+            "", [], report_data, candidate_evaluations, criteria_comparison_data, general_and_shortlist_data
+        ).getvalue()
+    finally:
+        docx_report.add_bulk_table = original_writer
+
+
+def document_xml(docx_bytes):
+    import io
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as archive:
+        xml = archive.read("word/document.xml").decode("utf-8")
+    return DATE_LINE_PATTERN.sub("Date: <normalized>", xml) # The report stamps the render time
+
+
+def measure_in_this_process(writer, num_candidates):
+    render(writer, 1) # Warm up imports so they don't count towards the render
+    tracemalloc.start()
+    start = time.perf_counter()
+    docx_bytes = render(writer, num_candidates)
+    elapsed = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {"seconds": elapsed, "tracemalloc_peak_mb": traced_peak / 2**20,
+            "max_rss_mb": max_rss / 2**20, "docx_bytes": len(docx_bytes)}
+
+
+def documents_identical(num_candidates):
+    return document_xml(render("bulk", num_candidates)) == document_xml(render("cell_by_cell", num_candidates))
+
+
+def run_worker(task, num_candidates):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", task, str(num_candidates)],
+        cwd=REPO_ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr or result.stdout)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DOCX report rendering benchmark: bulk table writer vs. the cell-by-cell python-docx path.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--worker", nargs=2, metavar=("TASK", "CANDIDATES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        task, num_candidates = args.worker
+        if task == "compare":
+            print(json.dumps({"identical": documents_identical(int(num_candidates))}))
+        else:
+            print(json.dumps(measure_in_this_process(task, int(num_candidates))))
+        return
+
+    results = []
+    for num_candidates in args.sizes:
+        row = {"candidates": num_candidates, "identical_document_xml": run_worker("compare", num_candidates)["identical"]}
+        for writer in ("cell_by_cell", "bulk"):
+            runs = [run_worker(writer, num_candidates) for _ in range(args.runs)]
+            median = sorted(runs, key=lambda r: r["seconds"])[len(runs) // 2]
+            row[writer] = {
+                "seconds_median": round(median["seconds"], 4),
+                "tracemalloc_peak_mb": round(max(r["tracemalloc_peak_mb"] for r in runs), 2),
+                "max_rss_mb": round(max(r["max_rss_mb"] for r in runs), 1),
+            }
+        row["speedup"] = round(row["cell_by_cell"]["seconds_median"] / row["bulk"]["seconds_median"], 1)
+        results.append(row)
+        print(json.dumps(row), file=sys.stderr) # Progress, the larger sizes take a while on the old path
+
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if all(row["identical_document_xml"] for row in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Cold-start benchmark for app.py.
+#
+# Measures (1) the import time of the modules app.py imports at the top level, in a fresh
+# interpreter, and (2) time-to-first-render of the login page via Streamlit's AppTest, then
+# compares both against the app's STARTUP_BUDGET_SECONDS.
+#
+# Usage (from the repository root): python benchmarks/bench_startup.py [--runs N]
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(REPO_ROOT, "app.py")
+
+# Placeholder secrets: the login page must render without touching any external service
+DUMMY_SECRETS = {
+    "FIREBASE_SERVICE_ACCOUNT_KEY": "{}",
+    "GOOGLE_DRIVE_KEY": "{}",
+    "OPENAI_API_KEY": "sk-benchmark",
+    "GOOGLE_DRIVE_REPORTS_FOLDER_ID": "benchmark-folder",
+}
+
+
+def top_level_imports(path):
+    # Module names imported at the top level of the script (not inside functions)
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return sorted(set(modules))
+
+
+def measure_import_seconds(modules):
+    code = (
+        "import time; start = time.perf_counter()\n"
+        + "".join(f"import {module}\n" for module in modules)
+        + "print(time.perf_counter() - start)"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def measure_first_render_seconds():
+    # Fresh interpreter per run, so nothing is cached from a previous render
+    code = (
+        "import json, sys, time\n"
+        "from streamlit.testing.v1 import AppTest\n"
+        f"app = AppTest.from_file({APP_PATH!r}, default_timeout=60)\n"
+        f"for key, value in {DUMMY_SECRETS!r}.items(): app.secrets[key] = value\n"
+        "start = time.perf_counter()\n"
+        "app.run()\n"
+        "elapsed = time.perf_counter() - start\n"
+        "if app.exception: sys.exit(f'App raised: {app.exception}')\n"
+        "print(elapsed)"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr or result.stdout)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def read_startup_budget():
+    with open(APP_PATH, "r", encoding="utf-8") as f:
+        for node in ast.parse(f.read()).body:
+            if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "STARTUP_BUDGET_SECONDS" for t in node.targets):
+                return ast.literal_eval(node.value)
+    raise RuntimeError("STARTUP_BUDGET_SECONDS not found in app.py")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for app.py: import time and time-to-first-render of the login page.")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    modules = top_level_imports(APP_PATH)
+    import_times = [measure_import_seconds(modules) for _ in range(args.runs)]
+    render_times = [measure_first_render_seconds() for _ in range(args.runs)]
+    budget = read_startup_budget()
+
+    results = {
+        "top_level_modules": modules,
+        "import_seconds_median": sorted(import_times)[len(import_times) // 2],
+        "first_render_seconds_median": sorted(render_times)[len(render_times) // 2],
+        "startup_budget_seconds": budget,
+    }
+    results["within_budget"] = results["first_render_seconds_median"] <= budget
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if results["within_budget"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# --- Document Text Extraction ---
+# Kept in its own module (rather than in app.py) so that extraction can run in worker
+# processes: functions defined inside the Streamlit script can't be pickled for a process pool.
+import hashlib
+import io
+import os
+import signal
+import zipfile
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+
+# Caps that keep extraction time and memory bounded however large the upload is. Text beyond
+# MAX_DOCUMENT_CHARS (roughly 15k tokens) wouldn't fit usefully in the AI prompts anyway.
+MAX_PDF_PAGES = 40
+MAX_DOCUMENT_CHARS = 60000
+
+def iter_pdf_page_texts(file, max_pages=MAX_PDF_PAGES):
+    # Pages are parsed lazily, one at a time, so a consumer that stops early skips the rest
+    from PyPDF2 import PdfReader # Imported on first use to keep app start-up light
+    pdf_reader = PdfReader(file)
+    for page_number, page in enumerate(pdf_reader.pages):
+        if page_number >= max_pages:
+            break
+        yield page.extract_text() or ""
+
+def join_within_budget(chunks, max_chars):
+    # Joins text chunks once (no repeated string concatenation), stopping as soon as max_chars is reached
+    parts = []
+    total_chars = 0
+    for chunk in chunks:
+        if total_chars + len(chunk) >= max_chars:
+            parts.append(chunk[:max_chars - total_chars])
+            break
+        parts.append(chunk)
+        total_chars += len(chunk)
+    return "".join(parts)
+
+def get_pdf_text(file, max_pages=MAX_PDF_PAGES, max_chars=MAX_DOCUMENT_CHARS):
+    return join_within_budget(iter_pdf_page_texts(file, max_pages), max_chars)
+
+def get_docx_text(file, max_chars=MAX_DOCUMENT_CHARS):
+    from docx import Document # Imported on first use to keep app start-up light
+    document = Document(file)
+    return join_within_budget((paragraph.text + "\n" for paragraph in document.paragraphs), max_chars)
+
+# Part of the text cache key, so changing the caps doesn't serve text extracted under the old ones
+EXTRACTION_LIMITS_TAG = f"p{MAX_PDF_PAGES}-c{MAX_DOCUMENT_CHARS}"
+
+EXTRACTORS = {"pdf": get_pdf_text, "docx": get_docx_text}
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+class ExtractionWorkerStalled(Exception):
+    # Raised by extract_texts_in_pool when a file outlives the caller-side deadline: its worker is
+    # stuck where SIGALRM can't reach it (e.g. in C code) and stays busy for the life of the pool,
+    # so the pool has to be replaced. Carries the rows finished so far, the stalled file's timeout
+    # row included (`completed_results`), and the (file_kind, file_bytes) pairs still in flight
+    # (`unfinished_files`), which weren't at fault and can be resubmitted to the new pool.
+    pass
+
+def _raise_extraction_timeout(signum, frame):
+    raise ExtractionTimeout()
+
+def extract_text_from_bytes(file_kind, file_bytes, timeout=None):
+    # In a worker process this runs on the main thread, so SIGALRM can interrupt a pathological
+    # file after `timeout` seconds. Where SIGALRM isn't available (Windows, or non-main threads)
+    # the caller's own deadline in extract_texts_in_pool still applies.
+    use_alarm = bool(timeout) and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_extraction_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return EXTRACTORS[file_kind](io.BytesIO(file_bytes))
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def extract_texts_in_pool(executor, files, timeout, num_workers):
+    # Fans (file_kind, file_bytes) pairs out over a process pool. Returns one (text, error) tuple
+    # per file, in input order; a file that fails or times out gets text=None and an error message
+    # without affecting the rest of the batch. `files` may be a generator (e.g. streaming ZIP
+    # members): at most two files per worker are held in flight, so memory stays bounded.
+    #
+    # If a worker process dies the whole pool is broken: the files in flight are collected (those
+    # that finished before the crash keep their text, the rest get an error) and BrokenProcessPool
+    # is raised, carrying every row so far as `completed_results`. A stuck worker raises
+    # ExtractionWorkerStalled instead. Either way, files not yet taken from `files` are left there
+    # for the caller to resume on a new pool.
+    max_in_flight = 2 * max(num_workers, 1)
+    in_flight = deque()
+    results = []
+    pool_error = None
+
+    def collect_oldest():
+        nonlocal pool_error
+        future, _, _ = in_flight.popleft()
+        try:
+            # At most one other file per worker can be queued ahead of the oldest one
+            results.append((future.result(timeout=2 * timeout + 5), None))
+        except ExtractionTimeout: # Interrupted by SIGALRM in the worker, which is free again
+            results.append((None, f"Timed out after {timeout} seconds."))
+        except FutureTimeoutError:
+            results.append((None, f"Timed out after {timeout} seconds."))
+            raise ExtractionWorkerStalled()
+        except BrokenProcessPool as e:
+            pool_error = pool_error or e
+            results.append((None, f"Extraction worker crashed: {e}"))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+
+    try:
+        for file_kind, file_bytes in files:
+            try:
+                future = executor.submit(extract_text_from_bytes, file_kind, file_bytes, timeout)
+            except BrokenProcessPool as e:
+                # Kept in line as a failed future, so its error row lands in input order
+                future = Future()
+                future.set_exception(e)
+            in_flight.append((future, file_kind, file_bytes))
+            if len(in_flight) >= max_in_flight:
+                collect_oldest()
+            if pool_error is not None or future.done() and isinstance(future.exception(), BrokenProcessPool):
+                break # Nothing more can be submitted to this pool
+        while in_flight:
+            collect_oldest()
+    except ExtractionWorkerStalled as e:
+        e.completed_results = results
+        e.unfinished_files = [(file_kind, file_bytes) for _, file_kind, file_bytes in in_flight]
+        raise
+    if pool_error is not None:
+        pool_error.completed_results = results
+        raise pool_error
+    return results
+
+# --- Bulk (ZIP) Ingestion ---
+SUPPORTED_EXTENSIONS = {".pdf": "pdf", ".docx": "docx"}
+MAX_ZIP_MEMBER_BYTES = 25 * 1024 * 1024 # Also guards against zip bombs
+
+def iter_zip_documents(zip_file, seen_hashes=None, skipped=None):
+    # Streams the supported documents out of a ZIP archive as (name, file_kind, file_bytes), reading
+    # one member at a time instead of unpacking the archive. Unsupported, oversized and duplicate
+    # (same content) members are skipped as they are met and appended to `skipped` as (name, reason).
+    seen_hashes = set() if seen_hashes is None else seen_hashes
+    skipped = [] if skipped is None else skipped
+    with zipfile.ZipFile(zip_file) as archive:
+        for member in archive.infolist():
+            name = member.filename
+            basename = os.path.basename(name)
+            if member.is_dir() or name.startswith("__MACOSX/") or basename.startswith("."):
+                continue # Folders and OS metadata, not worth reporting
+            file_kind = SUPPORTED_EXTENSIONS.get(os.path.splitext(basename)[1].lower())
+            if file_kind is None:
+                skipped.append((name, "Unsupported file type."))
+                continue
+            if member.file_size > MAX_ZIP_MEMBER_BYTES:
+                skipped.append((name, "File is too large."))
+                continue
+            with archive.open(member) as member_file:
+                file_bytes = member_file.read(MAX_ZIP_MEMBER_BYTES + 1)
+            if len(file_bytes) > MAX_ZIP_MEMBER_BYTES: # Header understated the real size
+                skipped.append((name, "File is too large."))
+                continue
+            digest = hashlib.sha256(file_bytes).hexdigest()
+            if digest in seen_hashes:
+                skipped.append((name, "Duplicate of another CV."))
+                continue
+            seen_hashes.add(digest)
+            yield name, file_kind, file_bytes
@@ -0,0 +1,164 @@
+# --- DOCX Report Rendering ---
+# Kept in its own module (rather than in app.py) so the renderer can be imported and benchmarked
+# without starting the Streamlit app (see benchmarks/bench_docx_tables.py).
+import io
+import re
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+
+# --- Bulk Table Writer ---
+# Filling tables through python-docx (table.add_row(), cell.text = ..., runs[0].font.bold = ...)
+# creates and looks up proxy objects for every cell, which gets slow and memory hungry for large
+# candidate pools. add_bulk_table builds the XML for all rows as a single string and parses it once,
+# producing exactly the elements python-docx would have written for the same calls.
+RUN_CONTENT_SPLIT_PATTERN = re.compile(r'([\t\r\n])')
+
+def run_content_xml(text):
+    # Mirrors python-docx's Run.text setter: tabs become <w:tab/>, newlines and carriage returns
+    # <w:br/>, and text with leading/trailing whitespace gets xml:space="preserve"
+    parts = []
+    for segment in RUN_CONTENT_SPLIT_PATTERN.split(text):
+        if segment == "\t":
+            parts.append('<w:tab/>')
+        elif segment in ("\r", "\n"):
+            parts.append('<w:br/>')
+        elif segment:
+            if len(segment.strip()) < len(segment):
+                parts.append(f'<w:t xml:space="preserve">{escape(segment)}</w:t>')
+            else:
+                parts.append(f'<w:t>{escape(segment)}</w:t>')
+    return "".join(parts)
+
+def cell_xml(text, width, bold=False, centered=False, vertically_centered=False):
+    v_align = '<w:vAlign w:val="center"/>' if vertically_centered else ''
+    p_pr = '<w:pPr><w:jc w:val="center"/></w:pPr>' if centered else ''
+    r_pr = '<w:rPr><w:b/></w:rPr>' if bold else ''
+    return (f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/>{v_align}</w:tcPr>'
+            f'<w:p>{p_pr}<w:r>{r_pr}{run_content_xml(str(text))}</w:r></w:p></w:tc>')
+
+def add_bulk_table(document, headers, rows, bold_columns=(), centered_columns=(), style='Table Grid'):
+    # Adds a table with a bold, centered header row followed by `rows` (lists of cell values).
+    # Equivalent to filling the table cell by cell through python-docx, but one parse for the whole table.
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls, qn
+
+    table = document.add_table(rows=0, cols=len(headers)) # python-docx lays out tblPr and the column grid
+    table.style = style
+    widths = [grid_col.get(qn('w:w')) for grid_col in table._tbl.tblGrid.gridCol_lst]
+
+    xml_parts = [f'<w:tbl {nsdecls("w")}><w:tr>']
+    for header_text, width in zip(headers, widths):
+        xml_parts.append(cell_xml(header_text, width, bold=True, centered=True, vertically_centered=True))
+    xml_parts.append('</w:tr>')
+    column_formats = [(width, i in bold_columns, i in centered_columns) for i, width in enumerate(widths)]
+    for row in rows:
+        xml_parts.append('<w:tr>')
+        for value, (width, bold, centered) in zip(row, column_formats):
+            xml_parts.append(cell_xml(value, width, bold=bold, centered=centered))
+        xml_parts.append('</w:tr>')
+    xml_parts.append('</w:tbl>')
+    table._tbl.extend(list(parse_xml("".join(xml_parts))))
+    return table
+
+
+# --- Report Generation Function (MODIFIED FOR NEW FORMAT) ---
+def create_comparative_docx_report(jd_text, cv_texts, report_data, candidate_evaluations, criteria_comparison_data, general_and_shortlist_data):
+    from docx import Document # Imported on first use to keep app start-up light
+
+    document = Document()
+
+    document.add_heading('JD-CV Comparative Analysis Report', level=1)
+    
+    # Add a paragraph for general info
+    document.add_paragraph(f"Generated by {report_data.get('generated_by_username', report_data.get('generated_by_email'))}")
+    document.add_paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    document.add_paragraph(f"Job Description: {report_data.get('jd_filename', 'N/A')}")
+    document.add_paragraph(f"Candidates: {', '.join(report_data.get('cv_filenames', ['N/A']))}")
+    tiered_evaluation = bool(report_data.get('escalation_band'))
+    if tiered_evaluation:
+        low, high = report_data['escalation_band']
+        document.add_paragraph(f"Tiered evaluation: candidates scoring {low}-{high}% in the first pass were re-evaluated with the full model.")
+    if report_data.get('failed_steps'):
+        document.add_paragraph(f"Partial results: AI analysis failed for {'; '.join(report_data['failed_steps'])}. "
+                               "Affected candidates are marked 'AI analysis failed.' and affected criteria ratings 'N/A'.")
+    
+    document.add_page_break()
+
+    # --- Candidate Evaluation Table ---
+    document.add_heading('🧾 Candidate Evaluation Table', level=2)
+    document.add_paragraph('Detailed assessment of each candidate against the Job Description:')
+
+    if candidate_evaluations:
+        headers = ["Candidate Name", "Match %", "Ranking", "Shortlist Probability", "Key Strengths", "Key Gaps", "Location Suitability", "Comments"]
+        if tiered_evaluation:
+            headers.append("Evaluated By")
+        rows = [
+            [
+                candidate.get('CandidateName', 'N/A'),
+                f"{candidate.get('MatchPercent', 0)}%",
+                str(candidate.get('Ranking', 'N/A')),
+                candidate.get('ShortlistProbability', 'N/A'),
+                candidate.get('KeyStrengths', 'N/A'),
+                candidate.get('KeyGaps', 'N/A'),
+                candidate.get('LocationSuitability', 'N/A'),
+                candidate.get('Comments', 'N/A')
+            ] + ([candidate.get('EvaluationModel', 'N/A')] if tiered_evaluation else [])
+            for candidate in candidate_evaluations
+        ]
+        add_bulk_table(document, headers, rows)
+    else:
+        document.add_paragraph("No candidate evaluation data available.")
+
+    document.add_page_break()
+
+    # --- Criteria Comparison Table ---
+    document.add_heading('✅ Additional Observations (Criteria Comparison)', level=2)
+
+    if criteria_comparison_data and candidate_evaluations:
+        # Get all unique candidate names from evaluations to ensure consistent column order
+        candidate_names_ordered = [cand['CandidateName'] for cand in candidate_evaluations]
+        
+        # Prepare headers: "Criteria" + all candidate names
+        criteria_headers = ["Criteria"] + candidate_names_ordered
+
+        # One row per criterion: the criterion name (bold) followed by each candidate's emoji (centered)
+        rows = [
+            [criteria] + [candidate_ratings.get(cand_name, 'N/A') for cand_name in candidate_names_ordered]
+            for criteria, candidate_ratings in criteria_comparison_data.items()
+        ]
+        add_bulk_table(document, criteria_headers, rows, bold_columns={0},
+                       centered_columns=set(range(1, len(criteria_headers))))
+    else:
+        document.add_paragraph("No criteria comparison data available.")
+
+    document.add_page_break()
+
+    # --- Local Pre-screening Scores (only when the pre-screen was used) ---
+    prescreen_results = report_data.get('prescreen_results')
+    if prescreen_results:
+        document.add_heading('🔎 Local Pre-screening Scores', level=2)
+        document.add_paragraph('Similarity of every uploaded CV to the Job Description, computed locally before AI evaluation:')
+        headers = ["CV File", "Pre-screen Score", "Sent to AI"]
+        rows = [
+            [result['Filename'], f"{result['PrescreenScore']}%", "Yes" if result['SentToAI'] else "No"]
+            for result in sorted(prescreen_results, key=lambda r: r['PrescreenScore'], reverse=True)
+        ]
+        add_bulk_table(document, headers, rows)
+        document.add_page_break()
+
+    # --- General Observations and Shortlist ---
+    document.add_heading('General Observations', level=2)
+    document.add_paragraph(general_and_shortlist_data.get('GeneralObservations', 'No general observations available.'))
+
+    document.add_heading('📌 Final Shortlist Recommendation', level=2)
+    if general_and_shortlist_data.get('ShortlistedCandidates'):
+        document.add_paragraph(f"Shortlisted candidates: {', '.join(general_and_shortlist_data.get('ShortlistedCandidates'))}")
+    else:
+        document.add_paragraph("No candidates recommended for shortlist based on current analysis.")
+
+    # Save the document to a BytesIO object
+    buffer = io.BytesIO()
+    document.save(buffer)
+    buffer.seek(0)
+    return buffer